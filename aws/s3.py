@@ -1,17 +1,37 @@
-from fastapi import APIRouter, File, UploadFile, Response
+from typing import Annotated
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, UploadFile, Response
 
 import boto3
-from botocore.exceptions import NoCredentialsError
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from redis.asyncio import Redis
+from sqlalchemy import select, insert, delete
+
+from database import db_dependency, asyncSessionLocal
+from models import Product, Image, ImageVariant
+from schemas import ImageResponse, ImageUploadRequest, ImageUploadResponse, ImageUploadConfirm
+from routers.utils.cache import bump_generations
+from routers.utils.services import get_redis, evict_cached_products, product_namespaces
+from aws.variants import render_variants
 
 from starlette import status 
 
 from dotenv import load_dotenv
+import asyncio
+import functools
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime 
 
 
 load_dotenv()
 
+logger = logging.getLogger("uvicorn.error")
+
 router = APIRouter(
     prefix="/files",
     tags=["files"]
@@ -22,19 +42,184 @@ AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 REGION_NAME = os.getenv("REGION_NAME")
+
+# boto3 is blocking, so every S3 call runs on this pool instead of the event
+# loop. The bound caps concurrent transfers across all uploads.
+S3_UPLOAD_WORKERS = int(os.getenv("S3_UPLOAD_WORKERS", 8))
+# Uploads are sent one part at a time, so this is the memory held per upload.
+# S3 rejects parts under 5 MiB, except the last one.
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+
+# Direct uploads from the admin panel, see /files/presign
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", 600))
+S3_MAX_IMAGE_SIZE = int(os.getenv("S3_MAX_IMAGE_SIZE", 10 * 1024 * 1024))
+S3_KEY_PREFIX = "texnotech/"
+# Content addressed keys never change content, see upload_image
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Resizing is CPU bound and would hold the GIL, so it runs in worker processes
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
 s3_client = boto3.client(
     "s3",
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
     region_name=REGION_NAME,
+    config=Config(max_pool_connections=S3_UPLOAD_WORKERS),
 )
+s3_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3")
+# Spawned rather than forked: workers only import aws.variants, and forking
+# a process with running threads and an event loop is unsafe
+image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
 
 ALLOWED_IMAGE_TYPES = ["image/png", "image/gif", "image/avif", "image/jpg", 
     "image/jpeg", "image/jfif", "image/pjpeg", "image/pjp", "image/svg", "image/webp"]
 
+redis_dependency = Annotated[Redis, Depends(get_redis)]
+
+
+def image_key(filename: str):
+    return S3_KEY_PREFIX + filename + str(datetime.now())
+
+
+def content_key(digest: str, content_type: str):
+    # The same bytes always land on the same key, whatever the filename
+    return S3_KEY_PREFIX + digest + (mimetypes.guess_extension(content_type) or "")
+
+
+def image_url(key: str):
+    return f"https://{BUCKET_NAME}.s3.{REGION_NAME}.amazonaws.com/{key}"
+
+
+async def run_s3(method, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(s3_executor, functools.partial(method, **kwargs))
+
+
+async def generate_variants(key: str, content_type: str, redis: Redis):
+    """Background task: store resized copies of an original next to it.
+
+    Variants are recorded in image_variants against the original's URL, so
+    every image row or product pointing at it picks them up.
+    """
+    if content_type == "image/svg":
+        return
+
+    source_link = image_url(key)
+    try:
+        original = await run_s3(s3_client.get_object, Bucket=BUCKET_NAME, Key=key)
+        # The original is read whole and copied to the worker process, so
+        # only images the presigned uploads would accept get variants
+        if original["ContentLength"] > S3_MAX_IMAGE_SIZE:
+            original["Body"].close()
+            logger.info(f"No image variants for {key}, {original['ContentLength']} bytes is over S3_MAX_IMAGE_SIZE")
+            return
+        data = await run_s3(original["Body"].read)
+        variants = await asyncio.get_running_loop().run_in_executor(image_executor, render_variants, data)
+        del data
+
+        variant_keys = [f"{key}.{variant['size']}.{variant['format']}" for variant in variants]
+        await asyncio.gather(*(
+            run_s3(s3_client.put_object, Bucket=BUCKET_NAME, Key=variant_key, Body=variant["body"], ContentType=variant["content_type"])
+            for variant, variant_key in zip(variants, variant_keys)
+        ))
+        rows = [
+            {
+                "source_link": source_link,
+                "size": variant["size"],
+                "format": variant["format"],
+                "image_link": image_url(variant_key),
+                "width": variant["width"],
+                "height": variant["height"],
+            }
+            for variant, variant_key in zip(variants, variant_keys)
+        ]
+    except Exception as e:
+        logger.warning(f"Image variants failed for {key}: {e}")
+        return
+    if not rows:
+        return
+
+    async with asyncSessionLocal() as db:
+        await db.execute(delete(ImageVariant).where(ImageVariant.source_link == source_link))
+        await db.execute(insert(ImageVariant), rows)
+        await db.commit()
+
+        # Usually nothing points at a fresh upload yet, but a product may
+        # already have been saved with its link
+        products = (await db.scalars(select(Product).where(Product.image_link == source_link))).all()
+        image_product_ids = (await db.scalars(select(Image.product_id).where(Image.image_link == source_link))).all()
+        namespaces = [namespace for product in products for namespace in await product_namespaces(db, redis, product)]
+
+    if namespaces:
+        await bump_generations(redis, *namespaces)
+    await evict_cached_products(redis, [product.id for product in products] + list(image_product_ids))
+
+
+async def hash_fileobj(file: UploadFile):
+    # The upload is already spooled by Starlette, so this is a local pass
+    # that runs before anything is sent to S3
+    digest = hashlib.sha256()
+    loop = asyncio.get_running_loop()
+    while chunk := await file.read(S3_PART_SIZE):
+        await loop.run_in_executor(s3_executor, digest.update, chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def object_exists(key: str):
+    try:
+        await run_s3(s3_client.head_object, Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+
+async def upload_fileobj(file: UploadFile, key: str, content_type: str, cache_control: str = None):
+    """Stream an upload to S3 without holding more than one part in memory.
+
+    A file smaller than one part goes up with a single put_object, anything
+    larger as a multipart upload that is aborted if a part fails, so S3 does
+    not keep billing for orphaned parts.
+    """
+    metadata = {"ContentType": content_type}
+    if cache_control:
+        metadata["CacheControl"] = cache_control
+
+    part = await file.read(S3_PART_SIZE)
+    if len(part) < S3_PART_SIZE:
+        await run_s3(s3_client.put_object, Bucket=BUCKET_NAME, Key=key, Body=part, **metadata)
+        return
+
+    upload = await run_s3(s3_client.create_multipart_upload, Bucket=BUCKET_NAME, Key=key, **metadata)
+    upload_id = upload["UploadId"]
+    try:
+        parts = []
+        while part:
+            number = len(parts) + 1
+            response = await run_s3(
+                s3_client.upload_part,
+                Bucket=BUCKET_NAME, Key=key, UploadId=upload_id, PartNumber=number, Body=part,
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": number})
+            part = await file.read(S3_PART_SIZE)
+        await run_s3(
+            s3_client.complete_multipart_upload,
+            Bucket=BUCKET_NAME, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        # Also on cancellation, when the client disconnects mid upload
+        try:
+            await run_s3(s3_client.abort_multipart_upload, Bucket=BUCKET_NAME, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.warning(f"Aborting multipart upload {upload_id} failed: {e}")
+        raise
+
 
 @router.post("", status_code=status.HTTP_201_CREATED)
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(background_tasks: BackgroundTasks, redis: redis_dependency, file: UploadFile = File(...)): # type: ignore
 
     try:
         if file.content_type not in ALLOWED_IMAGE_TYPES:
@@ -43,18 +228,71 @@ async def upload_image(file: UploadFile = File(...)):
                 content="Invalid file type. Only images are allowed."
             )
 
-        time = datetime.now()
-        file_content = await file.read()
-        file_name = "texnotech" +  "/" + file.filename + str(time)
-        s3_client.put_object(
-            Bucket=BUCKET_NAME,
-            Key=file_name,
-            Body=file_content,
-            ContentType=file.content_type,
-        )
-        file_url = f"https://{BUCKET_NAME}.s3.{REGION_NAME}.amazonaws.com/{file_name}"
-        return file_url
+        file_name = content_key(await hash_fileobj(file), file.content_type)
+        # Same photo uploaded again, its original and variants are already there
+        if await object_exists(file_name):
+            return image_url(file_name)
+
+        await upload_fileobj(file, file_name, file.content_type, IMMUTABLE_CACHE_CONTROL)
+        background_tasks.add_task(generate_variants, file_name, file.content_type, redis)
+        return image_url(file_name)
     except NoCredentialsError:
         return None
     except Exception as e:
         return None
+
+
+@router.post("/presign", response_model=ImageUploadResponse, status_code=status.HTTP_200_OK)
+async def presign_upload(upload: ImageUploadRequest):
+    """Let the admin panel upload an image straight to S3.
+
+    The returned url and fields make a multipart/form-data POST, with the
+    file as the last field. The signed policy pins the content type and
+    caps the size, so S3 rejects anything else. Register the upload with
+    /files/confirm afterwards.
+    """
+    if upload.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type. Only images are allowed.")
+
+    key = image_key(upload.filename)
+    # Signing is local, no request is made to S3
+    post = s3_client.generate_presigned_post(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        Fields={"Content-Type": upload.content_type},
+        Conditions=[
+            {"Content-Type": upload.content_type},
+            ["content-length-range", 1, S3_MAX_IMAGE_SIZE],
+        ],
+        ExpiresIn=S3_PRESIGN_EXPIRES,
+    )
+    return {"url": post["url"], "fields": post["fields"], "key": key, "expires_in": S3_PRESIGN_EXPIRES}
+
+
+@router.post("/confirm", response_model=ImageResponse, status_code=status.HTTP_201_CREATED)
+async def confirm_upload(upload: ImageUploadConfirm, background_tasks: BackgroundTasks, db: db_dependency, redis: redis_dependency): # type: ignore
+    if not upload.key.startswith(S3_KEY_PREFIX):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid key")
+
+    if upload.product_id is not None and not await db.get(Product, upload.product_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+
+    try:
+        head = await run_s3(s3_client.head_object, Bucket=BUCKET_NAME, Key=upload.key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+        raise
+
+    # The policy already enforced these, check what actually landed anyway
+    if head["ContentType"] not in ALLOWED_IMAGE_TYPES or head["ContentLength"] > S3_MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file type. Only images are allowed.")
+
+    new_image = Image(image_link=image_url(upload.key), product_id=upload.product_id)
+    db.add(new_image)
+    await db.commit()
+    await db.refresh(new_image)
+
+    await evict_cached_products(redis, [new_image.product_id])
+    background_tasks.add_task(generate_variants, upload.key, head["ContentType"], redis)
+    return new_image
@@ -0,0 +1,59 @@
+import io
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+
+# Vars
+
+# Longest side in pixels, images are never upscaled
+IMAGE_VARIANT_SIZES = {
+    "thumb": int(os.getenv("IMAGE_THUMB_SIZE", 320)),
+    "medium": int(os.getenv("IMAGE_MEDIUM_SIZE", 1024)),
+}
+
+IMAGE_VARIANT_FORMATS = {"webp": ("WEBP", "image/webp")}
+# AVIF needs Pillow built with libavif
+if features.check("avif"):
+    IMAGE_VARIANT_FORMATS["avif"] = ("AVIF", "image/avif")
+
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", 80))
+
+
+# Functions
+
+def render_variants(data: bytes):
+    """Resize an original image into every size and format.
+
+    CPU bound, runs in a worker process, see aws.s3.image_executor. Returns
+    dicts with size, format, content_type, width, height and body, or an
+    empty list when Pillow cannot read the file (SVG, corrupt uploads).
+    """
+    try:
+        original = Image.open(io.BytesIO(data))
+        original.load()
+    except (UnidentifiedImageError, OSError):
+        return []
+
+    # Phone photos are often stored sideways with an EXIF rotation flag
+    original = ImageOps.exif_transpose(original)
+    if original.mode not in ("RGB", "RGBA"):
+        # Palette and greyscale images, keeping any transparency
+        original = original.convert("RGBA")
+
+    variants = []
+    for size, pixels in IMAGE_VARIANT_SIZES.items():
+        image = original.copy()
+        image.thumbnail((pixels, pixels), Image.Resampling.LANCZOS)
+        for variant_format, (pil_format, content_type) in IMAGE_VARIANT_FORMATS.items():
+            body = io.BytesIO()
+            image.save(body, pil_format, quality=IMAGE_VARIANT_QUALITY)
+            variants.append({
+                "size": size,
+                "format": variant_format,
+                "content_type": content_type,
+                "width": image.width,
+                "height": image.height,
+                "body": body.getvalue(),
+            })
+    return variants
@@ -0,0 +1,69 @@
+"""Concurrent throughput of the sync session vs the AsyncSession.
+
+Runs the same product listing query from N concurrent coroutines, the way
+an uvicorn worker serves N simultaneous requests to an `async def` route:
+
+    python -m benchmarks.db_concurrency --concurrency 50 --requests 500
+
+With the sync session every query blocks the event loop, so the coroutines
+run one after another. With the AsyncSession they overlap on the database.
+Point URL_REMOTE_DATABASE at the real MySQL server: the gap comes from network
+round trips, a local SQLite file has none and favours the sync driver.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select
+from sqlalchemy.sql.expression import text
+
+from database import sessionLocal, asyncSessionLocal, async_engine
+from models import Product
+
+
+QUERY = select(Product).order_by(text("date_created DESC")).limit(20)
+
+
+async def sync_handler():
+    # What the routes did before: a blocking call inside a coroutine
+    db = sessionLocal()
+    try:
+        db.scalars(QUERY).all()
+    finally:
+        db.close()
+
+
+async def async_handler():
+    async with asyncSessionLocal() as db:
+        (await db.scalars(QUERY)).all()
+
+
+async def run(handler, concurrency: int, requests: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        async with semaphore:
+            await handler()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(requests)))
+    return time.perf_counter() - start
+
+
+async def main(concurrency: int, requests: int):
+    # Warm both pools so connection setup is not measured
+    await run(sync_handler, concurrency, concurrency)
+    await run(async_handler, concurrency, concurrency)
+
+    for name, handler in (("sync session", sync_handler), ("AsyncSession", async_handler)):
+        elapsed = await run(handler, concurrency, requests)
+        print(f"{name:>13}: {requests} requests in {elapsed:.2f}s, {requests / elapsed:.0f} req/s")
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.requests))
@@ -1,8 +1,16 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from typing import Annotated
+from fastapi import Depends, Request
+
+from sqlalchemy import create_engine, make_url, event
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 
@@ -11,8 +19,157 @@ load_dotenv()
 
 URL_DATABASE = os.getenv("URL_REMOTE_DATABASE")
 
-engine = create_engine(URL_DATABASE)
+# Connection pool, per engine and per worker process
+POOL_SETTINGS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    # Recycle before MySQL's wait_timeout drops idle connections
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+}
+# Only a queue pool is sized. aiosqlite gets a NullPool and in-memory SQLite a
+# SingletonThreadPool, both reject these.
+QUEUE_POOL_SETTINGS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+def pool_settings(url):
+    url = make_url(url)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        return POOL_SETTINGS
+    return {key: value for key, value in POOL_SETTINGS.items() if key not in QUEUE_POOL_SETTINGS}
+
+
+engine = create_engine(URL_DATABASE, **pool_settings(URL_DATABASE))
 
 sessionLocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+
+# Async drivers for the same databases, used by the API routes so a query
+# waits on the event loop instead of blocking the worker
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def async_database_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+URL_ASYNC_DATABASE = os.getenv("URL_ASYNC_DATABASE") or async_database_url(URL_DATABASE)
+
+async_engine = create_async_engine(URL_ASYNC_DATABASE, **pool_settings(URL_ASYNC_DATABASE))
+
+# Objects stay usable after commit, an expired attribute would need IO to reload
+asyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+# Optional read replica for catalog reads. Without one, reads use the primary.
+URL_REPLICA_DATABASE = os.getenv("URL_REPLICA_DATABASE")
+
+replica_engine = None
+replicaSessionLocal = asyncSessionLocal
+if URL_REPLICA_DATABASE:
+    URL_ASYNC_REPLICA_DATABASE = async_database_url(URL_REPLICA_DATABASE)
+    replica_engine = create_async_engine(URL_ASYNC_REPLICA_DATABASE, **pool_settings(URL_ASYNC_REPLICA_DATABASE))
+    replicaSessionLocal = async_sessionmaker(replica_engine, autoflush=False, expire_on_commit=False)
+
+# Read-your-writes: once a client commits a write, its reads go to the
+# primary for this long so replica lag does not hide its own changes
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", 10))
+REPLICA_PIN_COOKIE = "db_primary_pin"
+
+Base = declarative_base()
+
+
+# Pool metrics, for this worker process
+
+# A session takes its connection lazily, on its first query. The time from
+# starting its transaction to having the connection is the pool checkout wait.
+checkout_stats = {"checkouts": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+
+@event.listens_for(Session, "after_transaction_create")
+def _checkout_started(session, transaction):
+    if transaction.parent is None:
+        session.info["checkout_started"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _mark_committed(session):
+    session.info["committed"] = True
+
+
+@event.listens_for(Session, "after_begin")
+def _checkout_finished(session, transaction, connection):
+    started = session.info.pop("checkout_started", None)
+    if started is None:
+        return
+    wait = time.perf_counter() - started
+    checkout_stats["checkouts"] += 1
+    checkout_stats["wait_total"] += wait
+    checkout_stats["wait_max"] = max(checkout_stats["wait_max"], wait)
+
+
+def _pool_metrics(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        # Nothing to size or count, e.g. the NullPool of aiosqlite
+        return {"pool_class": type(pool).__name__}
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": POOL_SETTINGS["max_overflow"],
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        # Negative while the pool itself is not full yet
+        "overflow": pool.overflow(),
+    }
+
+
+def pool_metrics():
+    checkouts = checkout_stats["checkouts"]
+    return {
+        "primary": _pool_metrics(async_engine),
+        "replica": _pool_metrics(replica_engine) if replica_engine else None,
+        "checkouts": checkouts,
+        "checkout_timeouts": checkout_stats["timeouts"],
+        "checkout_wait_avg_ms": round(checkout_stats["wait_total"] / checkouts * 1000, 3) if checkouts else 0.0,
+        "checkout_wait_max_ms": round(checkout_stats["wait_max"] * 1000, 3),
+    }
+
+
+@asynccontextmanager
+async def _session(session_factory):
+    async with session_factory() as db:
+        try:
+            yield db
+        except PoolTimeoutError:
+            checkout_stats["timeouts"] += 1
+            raise
+
+
+async def get_db(request: Request):
+    # Primary session. main.primary_pin sets the pin cookie if it committed.
+    async with _session(asyncSessionLocal) as db:
+        request.state.primary_session = db
+        yield db
+
+
+async def get_read_db(request: Request):
+    # Replica session for read-only routes, unless the client is pinned
+    if request.cookies.get(REPLICA_PIN_COOKIE):
+        session_factory = asyncSessionLocal
+    else:
+        session_factory = replicaSessionLocal
+    async with _session(session_factory) as db:
+        yield db
+
+
+def primary_written(request: Request):
+    db = getattr(request.state, "primary_session", None)
+    return db is not None and db.info.get("committed", False)
+
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
\ No newline at end of file
@@ -1,24 +1,62 @@
-from fastapi import FastAPI  # type: ignore
+from fastapi import FastAPI, Request  # type: ignore
 from fastapi.middleware.cors import CORSMiddleware  # type: ignore
 from fastapi.middleware.trustedhost import TrustedHostMiddleware  # type: ignore
 from contextlib import asynccontextmanager
 import os
-from redis import Redis
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from routers import products, brands, category, p_specification, specifications, images, others, orders, order_items
 from routers.auth import auth
 from aws import s3
+from database import asyncSessionLocal, async_engine, replica_engine, primary_written, REPLICA_PIN_COOKIE, REPLICA_PIN_SECONDS
+from routers.utils.suggest import warm_suggestions
+from routers.utils.category_tree import warm_category_tree
+from routers.utils.counters import reconcile_counters_job
+from routers.utils.cache import create_redis
+from routers.utils.email import email_queue
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
     redis_url = os.getenv("REDIS_URL")
-    app.state.redis = Redis.from_url(redis_url)
+    app.state.redis = create_redis(redis_url)
+    await warm_suggestions(app.state.redis, asyncSessionLocal)
+    await warm_category_tree(app.state.redis, asyncSessionLocal)
+    # Auth handlers only enqueue mail, this sends it
+    await email_queue.start()
+
+    # Corrects drift of the incrementally maintained product counters
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(
+        reconcile_counters_job, "interval",
+        minutes=int(os.getenv("COUNTERS_RECONCILE_MINUTES", 15)),
+        args=[app.state.redis, asyncSessionLocal],
+    )
+    scheduler.start()
     yield
     # Shutdown code
-    app.state.redis.close()
+    scheduler.shutdown(wait=False)
+    await email_queue.stop()
+    # Lets in-flight uploads and resizes finish, stops the resize workers
+    s3.s3_executor.shutdown()
+    s3.image_executor.shutdown()
+    await app.state.redis.aclose()
+    await async_engine.dispose()
+    if replica_engine:
+        await replica_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def primary_pin(request: Request, call_next):
+    response = await call_next(request)
+    # A client that just wrote reads from the primary for a while, see database.get_read_db
+    if replica_engine and primary_written(request):
+        response.set_cookie(
+            REPLICA_PIN_COOKIE, "1", max_age=REPLICA_PIN_SECONDS,
+            httponly=True, secure=True, samesite="none",
+        )
+    return response
+
 # CORS Middleware
 app.add_middleware(
     CORSMiddleware,
@@ -33,6 +71,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
 
 # Include routers
@@ -1,5 +1,5 @@
 from sqlalchemy import (  # type: ignore
-    Boolean, Column, Integer, String, DateTime, Enum, ForeignKey, TIMESTAMP, text, Float
+    Boolean, Column, Integer, String, DateTime, Enum, ForeignKey, TIMESTAMP, text, Float, Index
 )
 from sqlalchemy.orm import relationship  # type: ignore
 from database import Base
@@ -84,6 +84,24 @@ class Product(Base):
     author = relationship("User", back_populates="products")
     specifications = relationship("ProductSpecification", back_populates="product")
     images = relationship("Image", back_populates="product", cascade="all, delete-orphan")
+    # Resized copies of image_link, see aws.s3.generate_variants. Never
+    # loaded implicitly: a selectin load on the connection of a streamed
+    # query discards the rest of its rows, so routes ask for it explicitly.
+    image_variants = relationship(
+        "ImageVariant",
+        primaryjoin="foreign(ImageVariant.source_link) == Product.image_link",
+        viewonly=True,
+        lazy="raise",
+    )
+
+    __table_args__ = (
+        # Serves ORDER BY date_created DESC and the keyset seek of product listings.
+        # Nothing creates tables or indexes here, run once on an existing database:
+        #   CREATE INDEX ix_products_date_created_id ON products (date_created, id);
+        Index("ix_products_date_created_id", "date_created", "id"),
+        # Backs search_query, see routers.utils.services.search_products
+        Index("ft_products_search", "name", "product_model", "search_string", mysql_prefix="FULLTEXT"),
+    )
 
 
 class Specification(Base):
@@ -107,6 +125,15 @@ class ProductSpecification(Base):
     product = relationship("Product", back_populates="specifications", passive_deletes=True)
     specification = relationship("Specification", back_populates="product_specifications")
 
+    __table_args__ = (
+        # (specification, value) -> product ids, read from the index alone by
+        # the spec filters of product listings, see routers.utils.services.spec_filter_products.
+        # Nothing creates tables or indexes here, run once on an existing database:
+        #   CREATE INDEX ix_product_specifications_spec_value_product
+        #       ON product_specifications (specification_id, value, product_id);
+        Index("ix_product_specifications_spec_value_product", "specification_id", "value", "product_id"),
+    )
+
 
 class Image(Base):
     __tablename__ = "images"
@@ -116,6 +143,26 @@ class Image(Base):
     product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=True)
 
     product = relationship("Product", back_populates="images")
+    variants = relationship(
+        "ImageVariant",
+        primaryjoin="foreign(ImageVariant.source_link) == Image.image_link",
+        viewonly=True,
+        lazy="selectin",
+    )
+
+
+class ImageVariant(Base):
+    # Keyed by the original's URL rather than an image id, because product
+    # main images are stored as a bare link on products.image_link
+    __tablename__ = "image_variants"
+
+    id = Column(Integer, primary_key=True, index=True)
+    source_link = Column(String(511), nullable=False, index=True)
+    size = Column(String(15), nullable=False)
+    format = Column(String(15), nullable=False)
+    image_link = Column(String(511), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
 
 
 class Order(Base):
@@ -4,13 +4,13 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 from starlette import status 
 
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 
-from database import sessionLocal 
+from database import db_dependency
 from models import User
 from schemas import UserCreate, Token, EmailSchema, PasswordResetConfirmModel
 from routers.utils import email as email_service
@@ -36,29 +36,18 @@ bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
 
 
-def get_db():
-    db = sessionLocal()
-    
-    try:
-        yield db
-    finally:
-        db.close() 
-
-db_dependency = Annotated[Session, Depends(get_db)]
-
-
 # Create user
 @router.post("", status_code=status.HTTP_201_CREATED)
 async def create_user(db: db_dependency, create_user: UserCreate):
     
     # Check is user with this phone number already exists
-    user_phone_number = db.query(User).filter(User.phone == create_user.phone).first()
+    user_phone_number = (await db.scalars(select(User).where(User.phone == create_user.phone))).first()
     if user_phone_number:
         raise HTTPException(status_code=400, detail="User with this phone number already exists")
 
     # Check is user with this email already exists
     if create_user.email:
-        user_email = db.query(User).filter(User.email == create_user.email).first()
+        user_email = (await db.scalars(select(User).where(User.email == create_user.email))).first()
         if user_email:
             raise HTTPException(status_code=400, detail="User with this phone number already exists")
 
@@ -91,12 +80,12 @@ async def create_user(db: db_dependency, create_user: UserCreate):
         'url': email_verification_endpoint
     }
 
-    mail_status = await email_service.send_email_async(subject="Email Verification: Registration Confirmation",
+    mail_status = email_service.enqueue_email(subject="Email Verification: Registration Confirmation",
         email_to=create_user.email, body=mail_body, template='email_verification.html') 
 
     if mail_status:
         db.add(create_user_model)
-        db.commit()
+        await db.commit()
         return {
             "message":"mail for Email Verification has been sent, kindly check your inbox.",
             "status": status.HTTP_201_CREATED
@@ -114,7 +103,7 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
         db: db_dependency):
     
     # Check if user exists
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user or not user.is_active:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
     
@@ -156,9 +145,9 @@ async def refresh_access_token(refresh_token: str):
         )
 
 
-def authenticate_user(phone_number: str, password: str, db):
+async def authenticate_user(phone_number: str, password: str, db):
     
-    user = db.query(User).filter(User.phone == phone_number).first()
+    user = (await db.scalars(select(User).where(User.phone == phone_number))).first()
     # Check if user with such username exists
     if not user:
         return False
@@ -197,7 +186,7 @@ async def get_current_user(token: Annotated[str, Depends (oauth2_bearer)],
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                 detail='Could not validate user.')
         
-        user = db.query(User).filter(User.id == user_id).first()
+        user = await db.get(User, user_id)
         return {"phone": phone_number, 
                 "id": user_id,
                 "first_name": user.first_name,
@@ -221,7 +210,7 @@ async def verify_token(token: Annotated[str, Depends(oauth2_bearer)], db: db_dep
         if phone_number is None or user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token.")
 
-        user = db.query(User).filter(User.id == user_id).first()
+        user = await db.get(User, user_id)
         if user is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found.")
 
@@ -243,7 +232,7 @@ async def user_verification(token:str, db: db_dependency):
             detail= "Token for Email Verification has expired."
         )
     
-    user = db.query(User).filter(User.email == token_data['email']).first()
+    user = (await db.scalars(select(User).where(User.email == token_data['email']))).first()
 
     if not user:
         raise HTTPException(
@@ -258,8 +247,8 @@ async def user_verification(token:str, db: db_dependency):
         )
     
     user.mail_verified = True
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     
     return {
             'message':'Email Verification Successful',
@@ -271,7 +260,7 @@ async def user_verification(token:str, db: db_dependency):
 @router.post('/email/verification/resend', status_code=status.HTTP_201_CREATED)
 async def resend_email_verification(email_data:EmailSchema, db: db_dependency):
  
-    user_check = db.query(User).filter(User.email == email_data.email).first()
+    user_check = (await db.scalars(select(User).where(User.email == email_data.email))).first()
     if not user_check:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
         detail= "User information does not exist")
@@ -290,7 +279,7 @@ async def resend_email_verification(email_data:EmailSchema, db: db_dependency):
         'url': email_verification_endpoint
     }
 
-    mail_status = await email_service.send_email_async(subject="Email Verification: Registration Confirmation",
+    mail_status = email_service.enqueue_email(subject="Email Verification: Registration Confirmation",
     email_to=str(user_check.email), body=mail_body, template='email_verification.html')
 
     if mail_status:
@@ -311,7 +300,7 @@ async def password_reset_request(data: EmailSchema, db: db_dependency):
 
     email = data.email
     # Check if user with input email exists
-    if not db.query(User).filter(User.email == email).first():
+    if not (await db.scalars(select(User).where(User.email == email))).first():
         return {
             "message":"User with this email address doesn't exist",
             "status": status.HTTP_400_BAD_REQUEST
@@ -325,7 +314,7 @@ async def password_reset_request(data: EmailSchema, db: db_dependency):
         'project_name': "eventify.az",
         'url': link
     }
-    mail_status = await email_service.send_email_async(subject="Password reset",
+    mail_status = email_service.enqueue_email(subject="Password reset",
         email_to=email, body=mail_body, template='reset_password.html') 
 
     if mail_status:
@@ -360,7 +349,7 @@ async def reset_account_password(token: str, passwords: PasswordResetConfirmMode
     email = token_data["email"]
     if email:
         # Make sure user exists
-        user = db.query(User).filter(User.email == email).first()
+        user = (await db.scalars(select(User).where(User.email == email))).first()
         if not user:
             raise HTTPException(
                 detail="User doesn't exist", 
@@ -371,8 +360,8 @@ async def reset_account_password(token: str, passwords: PasswordResetConfirmMode
         # Update user password
         setattr(user, "hashed_password", passwd_hash)
         # Commit changes to database
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
 
         return {
             "message":"Password reset Successfully.",
@@ -395,9 +384,9 @@ async def user_data(user: Annotated[get_current_user, Depends()]):
 
 # Get user email verification status
 @router.get("/user/verification", status_code=status.HTTP_200_OK)
-def get_verification_status(email: str, db: db_dependency):
+async def get_verification_status(email: str, db: db_dependency):
 
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.scalars(select(User).where(User.email == email))).first()
     if user.mail_verified:
         return True
 
@@ -1,13 +1,18 @@
 from typing import List, Annotated
-from fastapi import APIRouter, Depends, HTTPException, status, Response # type: ignore
-from sqlalchemy.orm import Session # type: ignore
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Request # type: ignore
+from sqlalchemy import select
 from sqlalchemy.sql.expression import text # type: ignore
-from database import sessionLocal
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from database import db_dependency, read_db_dependency
 from models import Product, Category, Brand, User
 from schemas import BrandResponse, BrandBase, BrandCreate
 import logging
 from datetime import datetime
 import pytz # type: ignore
+from .utils.services import get_redis, make_etag, conditional_headers, table_conditional_headers, is_not_modified
+from .utils.cache import bump_generations, brand_ns
+from .utils.suggest import rebuild_suggestions
 
 
 TIMEZONE = pytz.timezone("Asia/Baku")
@@ -17,37 +22,40 @@ router = APIRouter(
     tags=["brands"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+redis_dependency = Annotated[Redis, Depends(get_redis)]
 logger = logging.getLogger("uvicorn.error")
 
 
 @router.get("", response_model=List[BrandResponse], status_code=status.HTTP_200_OK)
-async def get_all_brands(db: db_dependency): # type: ignore
-    brands = db.query(Brand).order_by(text("date_created DESC")).all()
+async def get_all_brands(request: Request, response: Response, db: read_db_dependency): # type: ignore
+    headers = await table_conditional_headers(db, Brand)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+
+    brands = (await db.scalars(select(Brand).order_by(text("date_created DESC")))).all()
     return brands
 
 @router.get("/{brand_id}", response_model=BrandResponse, status_code=status.HTTP_200_OK)
-async def get_brand(brand_id: int, db: db_dependency): # type: ignore
-    brand = db.query(Brand).filter(Brand.id == brand_id).first()
+async def get_brand(brand_id: int, request: Request, response: Response, db: read_db_dependency): # type: ignore
+    brand = await db.get(Brand, brand_id)
     if not brand:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Brand not found")
+
+    headers = conditional_headers(make_etag("brand", brand.id, brand.updated_at), brand.updated_at)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
     return brand
 
 @router.put("/{brand_id}", response_model=BrandResponse, status_code=status.HTTP_200_OK)
-async def update_brand(brand_id: int, brand_data: BrandCreate, db: db_dependency):
+async def update_brand(brand_id: int, brand_data: BrandCreate, db: db_dependency, redis: redis_dependency):
 
-    brand = db.query(Brand).filter(Brand.id == brand_id).first()
+    brand = await db.get(Brand, brand_id)
     if not brand:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Brand not found")
  
-    brand_name = db.query(Brand).filter(Brand.name == brand_data.name).first()
+    brand_name = (await db.scalars(select(Brand).where(Brand.name == brand_data.name))).first()
     if brand_name:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -58,15 +66,23 @@ async def update_brand(brand_id: int, brand_data: BrandCreate, db: db_dependency
         setattr(brand, key, value)
 
     brand.updated_at = datetime.now(TIMEZONE)
-    db.commit()
-    db.refresh(brand)
+    await db.commit()
+    await db.refresh(brand)
+
+    await bump_generations(redis, brand_ns(brand_id))
+    # Brand completions are shared by all its products, a rename is rare
+    # enough to just rebuild the suggestion index
+    try:
+        await rebuild_suggestions(db, redis)
+    except RedisError as e:
+        logger.warning(f"Suggestion rebuild after brand update failed: {e}")
     return brand
 
 
 @router.post("/add", response_model=BrandResponse, status_code=status.HTTP_201_CREATED)
 async def create_brand(brand_data: BrandCreate, db: db_dependency): # type: ignore
     
-    brend = db.query(Brand).filter(Brand.name == brand_data.name).first()               
+    brend = (await db.scalars(select(Brand).where(Brand.name == brand_data.name))).first()               
     if brend:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -75,17 +91,19 @@ async def create_brand(brand_data: BrandCreate, db: db_dependency): # type: igno
     
     new_brand = Brand(**brand_data.dict())
     db.add(new_brand)
-    db.commit()
-    db.refresh(new_brand)
+    await db.commit()
+    await db.refresh(new_brand)
     return new_brand
 
 @router.delete("/{brand_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_brand(brand_id: int, db: db_dependency): # type: ignore
+async def delete_brand(brand_id: int, db: db_dependency, redis: redis_dependency): # type: ignore
 
-    brand = db.query(Brand).filter(Brand.id == brand_id).first()
+    brand = await db.get(Brand, brand_id)
     if not brand:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Brand not found")
     
-    db.delete(brand)
-    db.commit()
+    await db.delete(brand)
+    await db.commit()
+
+    await bump_generations(redis, brand_ns(brand_id))
     return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
@@ -1,15 +1,24 @@
 from typing import List, Annotated
-from fastapi import APIRouter, Depends, HTTPException, status, Response # type: ignore
-from sqlalchemy.orm import Session # type: ignore
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Request # type: ignore
+from sqlalchemy import select, delete, func, distinct
 from sqlalchemy.sql.expression import text # type: ignore
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 import logging
+import orjson
 from datetime import datetime
 import pytz 
 
-from database import sessionLocal
-from models import Category, Specification, Product
-from schemas import CategoryResponse, CategoryBase, CategoryCreate, ChildCategoryCreate
+from database import db_dependency, read_db_dependency
+from models import Category, Specification, Product, ProductSpecification
+from schemas import CategoryResponse, CategoryBase, CategoryCreate, ChildCategoryCreate, CategoryTreeResponse, SpecificationFacet
+from .utils.services import get_redis, make_etag, conditional_headers, table_conditional_headers, is_not_modified
+from .utils.cache import bump_generations, category_ns, get_generations, make_key, cache_get, cache_set, replica_fill_blocked, CATALOG, CATEGORIES, SPECS, \
+    FACETS_CACHE_TTL
+from .utils.category_tree import get_category_tree
+from .utils.suggest import rebuild_suggestions
+from .utils.counters import reconcile_counters
 
 
 TIMEZONE = pytz.timezone("Asia/Baku")
@@ -19,59 +28,78 @@ router = APIRouter(
     tags=["categories"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+redis_dependency = Annotated[Redis, Depends(get_redis)]
 logger = logging.getLogger("uvicorn.error")
 
 
 @router.get("", response_model=List[CategoryResponse], status_code=status.HTTP_200_OK)
-async def get_all_categories(db: db_dependency): # type: ignore
-    category = db.query(Category).order_by(text("date_created DESC")).all()
+async def get_all_categories(request: Request, response: Response, db: read_db_dependency): # type: ignore
+    headers = await table_conditional_headers(db, Category)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+
+    category = (await db.scalars(select(Category).order_by(text("date_created DESC")))).all()
     return category
  
 
 @router.get("/parent", response_model=List[CategoryResponse], status_code=status.HTTP_200_OK)
-async def get_parent_categories(db: db_dependency): # type: ignore
-    category = db.query(Category).filter(Category.parent_category_id == None).order_by(text("date_created DESC")).all()
+async def get_parent_categories(db: read_db_dependency): # type: ignore
+    category = (await db.scalars(select(Category).where(Category.parent_category_id == None).order_by(text("date_created DESC")))).all()
     return category
 
 
+@router.get("/tree", response_model=List[CategoryTreeResponse], status_code=status.HTTP_200_OK)
+async def get_category_tree_all(db: read_db_dependency, redis: redis_dependency): # type: ignore
+    # Precomputed nested payload, rebuilt only after a category write
+    tree = await get_category_tree(db, redis)
+    return Response(content=tree["tree"], media_type="application/json")
+
+
 @router.get("/{category_id}", response_model=CategoryResponse, status_code=status.HTTP_200_OK)
-async def get_category(category_id: int, db: db_dependency): # type: ignore
-    category = db.query(Category).filter(Category.id == category_id).first()
+async def get_category(category_id: int, request: Request, response: Response, db: read_db_dependency): # type: ignore
+    category = await db.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
+
+    headers = conditional_headers(make_etag("category", category.id, category.updated_at), category.updated_at)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
     return category
 
 
 @router.delete("/{category_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_category(category_id: int, db: db_dependency):
-    category = db.query(Category).filter(Category.id == category_id).first()
+async def delete_category(category_id: int, db: db_dependency, redis: redis_dependency):
+    category = await db.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
     
     try:
-        db.query(Specification).filter(Specification.category_id == category_id).delete(synchronize_session=False)
-        db.query(Product).filter(Product.category_id == category_id).delete(synchronize_session=False)
-        db.delete(category)
-        db.commit()
+        await db.execute(delete(Specification).where(Specification.category_id == category_id).execution_options(synchronize_session=False))
+        await db.execute(delete(Product).where(Product.category_id == category_id).execution_options(synchronize_session=False))
+        await db.delete(category)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error deleting category: {str(e)}")
-    
+
+    # Its products are gone from every listing, not just the category ones
+    await bump_generations(redis, CATALOG, CATEGORIES)
+    # Suggestion members are reference counted per product, rebuilding is
+    # simpler than counting what each deleted product held
+    try:
+        await rebuild_suggestions(db, redis)
+        await reconcile_counters(db, redis)
+    except RedisError as e:
+        logger.warning(f"Redis refresh after category delete failed: {e}")
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @router.post("/add", response_model=CategoryResponse, status_code=status.HTTP_201_CREATED)
-async def create_category(category_data: CategoryCreate, db: db_dependency): # type: ignore
+async def create_category(category_data: CategoryCreate, db: db_dependency, redis: redis_dependency): # type: ignore
     
-    category = db.query(Category).filter(Category.name == category_data.name).first()               
+    category = (await db.scalars(select(Category).where(Category.name == category_data.name))).first()               
     if category:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -86,15 +114,17 @@ async def create_category(category_data: CategoryCreate, db: db_dependency): # t
     
     new_category = Category(**category_data.dict())
     db.add(new_category)
-    db.commit()
-    db.refresh(new_category)
+    await db.commit()
+    await db.refresh(new_category)
+
+    await bump_generations(redis, CATEGORIES)
     return new_category
 
 
 @router.post("/child/add", response_model=CategoryResponse, status_code=status.HTTP_201_CREATED)
-async def create_child_category(category_data: ChildCategoryCreate, db: db_dependency): # type: ignore
+async def create_child_category(category_data: ChildCategoryCreate, db: db_dependency, redis: redis_dependency): # type: ignore
     
-    category = db.query(Category).filter(Category.name == category_data.name).first()               
+    category = (await db.scalars(select(Category).where(Category.name == category_data.name))).first()               
     if category:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -109,20 +139,22 @@ async def create_child_category(category_data: ChildCategoryCreate, db: db_depen
     
     new_category = Category(**category_data.dict())
     db.add(new_category)
-    db.commit()
-    db.refresh(new_category)
+    await db.commit()
+    await db.refresh(new_category)
+
+    await bump_generations(redis, CATEGORIES)
     return new_category
 
 
 @router.put("/{category_id}", response_model=CategoryResponse, status_code=status.HTTP_200_OK)
-async def update_category(category_id: int, category_data: CategoryBase, db: db_dependency): # type: ignore
+async def update_category(category_id: int, category_data: CategoryBase, db: db_dependency, redis: redis_dependency): # type: ignore
 
-    category = db.query(Category).filter(Category.id == category_id).first()
+    category = await db.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
  
     
-    category_name = db.query(Category).filter(Category.name == category_data.name).first()
+    category_name = (await db.scalars(select(Category).where(Category.name == category_data.name))).first()
     if category_name:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -139,17 +171,19 @@ async def update_category(category_id: int, category_data: CategoryBase, db: db_
         setattr(category, key, value)
 
     category.updated_at = datetime.now(TIMEZONE)
-    db.commit()
-    db.refresh(category)
+    await db.commit()
+    await db.refresh(category)
+
+    await bump_generations(redis, CATEGORIES, category_ns(category_id))
     return category
 
 
 # Get all specifications of a Category
 @router.get("/values/{category_id}",  status_code=status.HTTP_200_OK)
-async def get_category_specifications(category_id: int, db: db_dependency): 
+async def get_category_specifications(category_id: int, db: read_db_dependency): 
 
     category_specifications = (
-        db.query(Specification).filter(Specification.category_id == category_id).all()
+        (await db.scalars(select(Specification).where(Specification.category_id == category_id))).all()
     )
 
     data = [
@@ -161,3 +195,35 @@ async def get_category_specifications(category_id: int, db: db_dependency):
     ]
 
     return data
+
+
+# Every specification of a Category with its distinct values and how many products have each
+@router.get("/facets/{category_id}", response_model=List[SpecificationFacet], status_code=status.HTTP_200_OK)
+async def get_category_spec_facets(category_id: int, db: read_db_dependency, redis: redis_dependency):
+    generations = await get_generations(redis, [CATALOG, SPECS])
+    cache_key = make_key("categories:spec-facets", {"category_id": category_id, "gen": generations}) if generations else None
+
+    cached = await cache_get(redis, cache_key) if cache_key else None
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    rows = await db.execute(
+        select(
+            Specification.id, Specification.name, ProductSpecification.value,
+            func.count(distinct(ProductSpecification.product_id)),
+        )
+        .join(ProductSpecification, ProductSpecification.specification_id == Specification.id)
+        .where(Specification.category_id == category_id)
+        .group_by(Specification.id, Specification.name, ProductSpecification.value)
+        .order_by(Specification.name, Specification.id, ProductSpecification.value)
+    )
+
+    facets = {}
+    for spec_id, name, value, count in rows:
+        facet = facets.setdefault(spec_id, {"id": spec_id, "name": name, "values": []})
+        facet["values"].append({"value": value, "count": count})
+
+    payload = orjson.dumps(list(facets.values()))
+    if cache_key and not await replica_fill_blocked(redis, db, CATALOG, SPECS):
+        await cache_set(redis, cache_key, payload, FACETS_CACHE_TTL)
+    return Response(content=payload, media_type="application/json")
@@ -1,10 +1,12 @@
 from typing import List, Annotated
 from fastapi import APIRouter, Depends, HTTPException, status, Response # type: ignore
-from sqlalchemy.orm import Session # type: ignore
+from sqlalchemy import select
 from sqlalchemy.sql.expression import text # type: ignore
-from database import sessionLocal
+from redis.asyncio import Redis
+from database import db_dependency, read_db_dependency
 from models import Product, Category, Brand, User, Image
 from schemas import ImageResponse, ImageCreate
+from .utils.services import get_redis, evict_cached_products
 import logging
 from datetime import datetime
 import pytz # type: ignore
@@ -17,67 +19,67 @@ router = APIRouter(
     tags=["images"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+redis_dependency = Annotated[Redis, Depends(get_redis)]
 logger = logging.getLogger("uvicorn.error")
 
 
 @router.get("", response_model=List[ImageResponse], status_code=status.HTTP_200_OK)
-async def get_all_images(db: db_dependency): # type: ignore
-    images = db.query(Image).all()
+async def get_all_images(db: read_db_dependency): # type: ignore
+    images = (await db.scalars(select(Image))).all()
     return images
 
 
 @router.get("/{product_id}", response_model=List[ImageResponse], status_code=status.HTTP_200_OK)
-async def get_images(product_id : int, db: db_dependency): # type: ignore
-    images = db.query(Image).filter(Image.product_id == product_id).all()
+async def get_images(product_id : int, db: read_db_dependency): # type: ignore
+    images = (await db.scalars(select(Image).where(Image.product_id == product_id))).all()
     if not images:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Images not found for products")
     return images
 
 @router.delete("/{image_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_image(image_id: int, db: db_dependency): # type: ignore
+async def delete_image(image_id: int, db: db_dependency, redis: redis_dependency): # type: ignore
 
-    image = db.query(Image).filter(Image.id == image_id).first()
+    image = await db.get(Image, image_id)
     if not image:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
     
-    db.delete(image)
-    db.commit()
+    product_id = image.product_id
+    await db.delete(image)
+    await db.commit()
+
+    await evict_cached_products(redis, [product_id])
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router.post("/add", response_model=ImageResponse, status_code=status.HTTP_201_CREATED)
-async def create_image(image_data: ImageCreate, db: db_dependency): # type: ignore
+async def create_image(image_data: ImageCreate, db: db_dependency, redis: redis_dependency): # type: ignore
     
     new_image = Image(**image_data.dict())
     db.add(new_image)
-    db.commit()
-    db.refresh(new_image)
+    await db.commit()
+    await db.refresh(new_image)
+
+    await evict_cached_products(redis, [new_image.product_id])
     return new_image
 
 
 @router.put("/{image_id}", response_model=ImageResponse, status_code=status.HTTP_200_OK)
-async def update_image(image_id: int, image_data: ImageCreate, db: db_dependency): # type: ignore
+async def update_image(image_id: int, image_data: ImageCreate, db: db_dependency, redis: redis_dependency): # type: ignore
 
-    image = db.query(Image).filter(Image.id == image_id).first()
+    image = await db.get(Image, image_id)
     if not image:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
     
-    ip = db.query(Product).filter(Product.id == image_data.product_id).first()
+    ip = await db.get(Product, image_data.product_id)
     if not ip:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     
 
-    
+    old_product_id = image.product_id
     for key, value in image_data.dict().items():
         setattr(image, key, value)
 
-    db.commit()
-    db.refresh(image)
+    await db.commit()
+    await db.refresh(image)
+
+    await evict_cached_products(redis, [old_product_id, image.product_id])
     return image
\ No newline at end of file
@@ -1,8 +1,9 @@
 from typing import List, Annotated
 from fastapi import APIRouter, Depends, HTTPException, status, Response  # type: ignore
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import text  # type: ignore
-from database import sessionLocal
+from database import db_dependency
 from models import Product, Order, OrderItem
 from schemas import ProductSpecificationResponse, OrderWithItems, OrderResponse, OrderCreate, OrderItemCreate, OrderItemResponse
 import logging
@@ -16,24 +17,16 @@ router = APIRouter(
     tags=["order_items"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 logger = logging.getLogger("uvicorn.error")
 
 @router.get("", response_model=List[OrderWithItems])
-def get_orders(db: Session = Depends(get_db)):
-    db_orders = db.query(OrderItem).all()
+async def get_orders(db: db_dependency):
+    db_orders = (await db.scalars(select(OrderItem))).all()
     return db_orders
 
 @router.get("/{order_id}", response_model=OrderItemResponse, status_code=status.HTTP_200_OK)
 async def get_order_item(order_id: int, db: db_dependency):  # type: ignore
-    order_item = db.query(OrderItem).filter(OrderItem.order_id == order_id).first()
+    order_item = (await db.scalars(select(OrderItem).where(OrderItem.order_id == order_id))).first()
     if not order_item:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order Item not found")
     return order_item
@@ -46,8 +39,8 @@ async def create_order_item(order_data: OrderItemCreate, db: db_dependency):  #
 
     new_order_item = OrderItem(**order_item_data_dict)
     db.add(new_order_item)
-    db.commit()
-    db.refresh(new_order_item)
+    await db.commit()
+    await db.refresh(new_order_item)
     return new_order_item
 
 
@@ -1,8 +1,9 @@
 from typing import List, Annotated
 from fastapi import APIRouter, Depends, HTTPException, status, Response  # type: ignore
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy.sql.expression import text  # type: ignore
-from database import sessionLocal
+from database import db_dependency
 from models import Product, Order, OrderItem
 from schemas import OrderWithItems, OrderResponse, OrderCreate, OrderPaymentUpdate, OrderStatusUpdate
 import logging
@@ -16,24 +17,16 @@ router = APIRouter(
     tags=["orders"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 logger = logging.getLogger("uvicorn.error")
 
 @router.get("", response_model=List[OrderWithItems])
-def get_orders(db: Session = Depends(get_db)):
-    db_orders = db.query(Order).all()
+async def get_orders(db: db_dependency):
+    db_orders = (await db.scalars(select(Order).options(selectinload(Order.order_items)))).all()
     return db_orders
 
 @router.get("/{order_id}", response_model=OrderResponse, status_code=status.HTTP_200_OK)
 async def get_order(order_id: int, db: db_dependency):  # type: ignore
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id, options=[selectinload(Order.order_items)])
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
     return order
@@ -45,24 +38,25 @@ async def create_order(order_data: OrderCreate, db: db_dependency):  # type: ign
 
     new_order = Order(**order_data_dict)
     db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
+    await db.commit()
+    # Responses include the items, loaded here as there is no lazy loading
+    await db.refresh(new_order, ["order_items"])
     return new_order
 
 @router.delete("/{order_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_order(order_id: int, db: db_dependency):
 
-    order = db.query(Order).filter(Order.id == order_id).first()
-    order_items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
+    order = await db.get(Order, order_id)
+    order_items = (await db.scalars(select(OrderItem).where(OrderItem.order_id == order_id))).all()
 
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
     
     for j in order_items:
-        db.delete(j)
-    db.delete(order)
+        await db.delete(j)
+    await db.delete(order)
     
-    db.commit()
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -72,7 +66,7 @@ async def update_order_status(order_id: int, update_data: OrderStatusUpdate, db:
     Update the status of an existing order.
     Expects a JSON payload with 'status' field, e.g., {"status": "shipped"}
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
@@ -87,8 +81,8 @@ async def update_order_status(order_id: int, update_data: OrderStatusUpdate, db:
     # Update the order's status
     order.status = update_data.status
     order.updated_at = datetime.now(TIMEZONE)  # Update timestamp
-    db.commit()
-    db.refresh(order)
+    await db.commit()
+    await db.refresh(order, ["order_items"])
     return order
 
 
@@ -98,7 +92,7 @@ async def update_order_payment(order_id: int, update_data: OrderPaymentUpdate, d
     Update the status of an existing order.
     Expects a JSON payload with 'status' field, e.g., {"status": "shipped"}
     """
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
@@ -106,6 +100,6 @@ async def update_order_payment(order_id: int, update_data: OrderPaymentUpdate, d
     # Update the order's status
     order.payment_status = update_data.payment_status
     order.updated_at = datetime.now(TIMEZONE)  # Update timestamp
-    db.commit()
-    db.refresh(order)
+    await db.commit()
+    await db.refresh(order, ["order_items"])
     return order
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, HTTPException, status, Response, Depends
 from typing import Annotated
-from redis import Redis
+from redis.asyncio import Redis
 
+from database import pool_metrics
 from .utils.services import get_redis
+from .utils.cache import bump_generations, CATALOG
 
 
 router = APIRouter(
@@ -17,7 +19,14 @@ redis_dependency = Annotated[Redis, Depends(get_redis)]
 @router.delete("/cache/clear", status_code=status.HTTP_204_NO_CONTENT)
 async def clear_cache(redis: redis_dependency):
     try:
-        redis.flushall()
+        # Orphan every cached entry without touching unrelated keys
+        await bump_generations(redis, CATALOG, strict=True)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/metrics/db-pool", status_code=status.HTTP_200_OK)
+async def get_db_pool_metrics():
+    # Per worker process: each uvicorn worker has its own pool
+    return pool_metrics()
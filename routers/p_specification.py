@@ -1,13 +1,18 @@
 from typing import List, Annotated
 from fastapi import APIRouter, Depends, HTTPException, status, Response # type: ignore
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.expression import text # type: ignore
-from database import sessionLocal
+from redis.asyncio import Redis
+from database import db_dependency, read_db_dependency
 from models import Product, Category, Brand, User, Category, ProductSpecification, Specification
-from schemas import  ProductSpecificationResponse, ProductSpecificationCreate, ProductSpecificationBase, ProductSpecificationUpdate
+from schemas import  ProductSpecificationResponse, ProductSpecificationCreate, ProductSpecificationBase, ProductSpecificationUpdate, \
+    ProductSpecificationBulkResponse
 import logging
 from datetime import datetime
 import pytz
+from .utils.services import get_redis, evict_cached_products
+from .utils.cache import bump_generations, SPECS
 
 TIMEZONE = pytz.timezone("Asia/Baku")
 
@@ -16,25 +21,20 @@ router = APIRouter(
     tags=["p_specification"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+redis_dependency = Annotated[Redis, Depends(get_redis)]
 logger = logging.getLogger("uvicorn.error")
 
+MAX_BULK_SPECIFICATIONS = 5000
+
 @router.get("", response_model=List[ProductSpecificationResponse], status_code=status.HTTP_200_OK)
-async def get_all_p_specification(db: db_dependency): # type: ignore
-    p_specification = db.query(ProductSpecification).all()
+async def get_all_p_specification(db: read_db_dependency): # type: ignore
+    p_specification = (await db.scalars(select(ProductSpecification))).all()
     return p_specification
 
 
 @router.get("/{p_specification_id}", response_model=ProductSpecificationResponse, status_code=status.HTTP_200_OK)
-async def get_p_specification(p_specification_id: int, db: db_dependency):
-    p_specification = db.query(ProductSpecification).filter(ProductSpecification.id == p_specification_id).first()
+async def get_p_specification(p_specification_id: int, db: read_db_dependency):
+    p_specification = await db.get(ProductSpecification, p_specification_id)
     
     if not p_specification:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product specification is not found")
@@ -43,41 +43,49 @@ async def get_p_specification(p_specification_id: int, db: db_dependency):
 
 
 @router.delete("/{p_specification_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_p_specification(p_specification_id: int, db: db_dependency): # type: ignore
-    p_specification = db.query(ProductSpecification).filter(ProductSpecification.id == p_specification_id).first()
+async def delete_p_specification(p_specification_id: int, db: db_dependency, redis: redis_dependency): # type: ignore
+    p_specification = await db.get(ProductSpecification, p_specification_id)
     if not p_specification:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product Specification not found")
     
-    db.delete(p_specification)
-    db.commit()
+    product_id = p_specification.product_id
+    await db.delete(p_specification)
+    await db.commit()
+
+    await evict_cached_products(redis, [product_id])
+    await bump_generations(redis, SPECS)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @router.delete("/product/{product_id}/{spec_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_p_specification_spec(product_id: int, spec_id: int, db: db_dependency): # type: ignore
-    p_specification = db.query(ProductSpecification)\
-        .filter(ProductSpecification.product_id == product_id,
-                ProductSpecification.specification_id == spec_id)\
-            .first()
+async def delete_p_specification_spec(product_id: int, spec_id: int, db: db_dependency, redis: redis_dependency): # type: ignore
+    p_specification = (await db.scalars(select(ProductSpecification)\
+        .where(ProductSpecification.product_id == product_id,
+               ProductSpecification.specification_id == spec_id)
+    )).first()
     if not p_specification:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product Specification not found")
     
-    db.delete(p_specification)
-    db.commit()
+    product_id = p_specification.product_id
+    await db.delete(p_specification)
+    await db.commit()
+
+    await evict_cached_products(redis, [product_id])
+    await bump_generations(redis, SPECS)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 
 @router.post("", response_model=ProductSpecificationResponse, status_code=status.HTTP_201_CREATED)
-async def create_product_specification(p_specification_data: ProductSpecificationCreate, db: db_dependency):  # type: ignore
-    product = db.query(Product).filter(Product.id == p_specification_data.product_id).first()
+async def create_product_specification(p_specification_data: ProductSpecificationCreate, db: db_dependency, redis: redis_dependency):  # type: ignore
+    product = await db.get(Product, p_specification_data.product_id)
     if not product:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
             detail="Product not found with the specified ID."
         )
 
-    specification = db.query(Specification).filter(Specification.id == p_specification_data.specification_id).first()
+    specification = await db.get(Specification, p_specification_data.specification_id)
     if not specification:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
@@ -86,15 +94,76 @@ async def create_product_specification(p_specification_data: ProductSpecificatio
     
     new_p_specification = ProductSpecification(**p_specification_data.dict())
     db.add(new_p_specification)
-    db.commit()
-    db.refresh(new_p_specification)
+    await db.commit()
+    await db.refresh(new_p_specification)
+
+    await evict_cached_products(redis, [new_p_specification.product_id])
+    await bump_generations(redis, SPECS)
     return new_p_specification
 
 
+@router.post("/bulk", response_model=ProductSpecificationBulkResponse, status_code=status.HTTP_200_OK)
+async def upsert_product_specifications(p_specifications_data: List[ProductSpecificationCreate], db: db_dependency, redis: redis_dependency):  # type: ignore
+    # Sets the value of each (product, specification) pair, updating the
+    # existing row or inserting one. A repeated pair keeps its last value.
+    if len(p_specifications_data) > MAX_BULK_SPECIFICATIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BULK_SPECIFICATIONS} product specifications per request"
+        )
+    values = {(item.product_id, item.specification_id): item.value for item in p_specifications_data}
+    if not values:
+        return {"inserted": 0, "updated": 0}
+
+    product_ids = {product_id for product_id, _ in values}
+    specification_ids = {specification_id for _, specification_id in values}
+
+    missing_products = product_ids - set((await db.scalars(select(Product.id).where(Product.id.in_(product_ids)))).all())
+    if missing_products:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, 
+            detail=f"Products not found with the specified IDs: {sorted(missing_products)}"
+        )
+    missing_specifications = specification_ids - set(
+        (await db.scalars(select(Specification.id).where(Specification.id.in_(specification_ids)))).all()
+    )
+    if missing_specifications:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, 
+            detail=f"Specifications not found with the specified IDs: {sorted(missing_specifications)}"
+        )
+
+    existing = await db.execute(
+        select(ProductSpecification.id, ProductSpecification.product_id, ProductSpecification.specification_id)
+        .where(ProductSpecification.product_id.in_(product_ids), ProductSpecification.specification_id.in_(specification_ids))
+    )
+    updates = []
+    found = set()
+    for p_specification_id, product_id, specification_id in existing:
+        if (product_id, specification_id) in values:
+            updates.append({"id": p_specification_id, "value": values[(product_id, specification_id)]})
+            found.add((product_id, specification_id))
+    inserts = [
+        {"product_id": product_id, "specification_id": specification_id, "value": value}
+        for (product_id, specification_id), value in values.items() if (product_id, specification_id) not in found
+    ]
+
+    # One executemany per kind, in a single transaction
+    if updates:
+        await db.execute(update(ProductSpecification), updates)
+    if inserts:
+        await db.execute(insert(ProductSpecification), inserts)
+    await db.commit()
+
+    await evict_cached_products(redis, list(product_ids))
+    await bump_generations(redis, SPECS)
+    return {"inserted": len(inserts), "updated": len(updates)}
+
+
 @router.put("/{p_specification_id}", response_model=ProductSpecificationResponse, status_code=status.HTTP_200_OK)
-async def update_p_specification(p_specification_id: int, p_specification_data: ProductSpecificationUpdate, db: db_dependency):  # type: ignore
+async def update_p_specification(p_specification_id: int, p_specification_data: ProductSpecificationUpdate, db: db_dependency, redis: redis_dependency):  # type: ignore
 
-    p_specification = db.query(ProductSpecification).filter(ProductSpecification.id == p_specification_id).first()
+    p_specification = await db.get(ProductSpecification, p_specification_id)
     if not p_specification:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
@@ -102,32 +171,37 @@ async def update_p_specification(p_specification_id: int, p_specification_data:
         )
     
 
-    product = db.query(Product).filter(Product.id == p_specification_data.product_id).first()
+    product = await db.get(Product, p_specification_data.product_id)
     if not product:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
             detail="Product not found with the specified ID."
         )    
     
+    old_product_id = p_specification.product_id
     for key, value in p_specification_data.dict().items():
         setattr(p_specification, key, value)
 
     p_specification.updated_at = datetime.now(TIMEZONE)
-    db.commit()
-    db.refresh(p_specification)
+    await db.commit()
+    await db.refresh(p_specification)
+
+    await evict_cached_products(redis, [old_product_id, p_specification.product_id])
+    await bump_generations(redis, SPECS)
     return p_specification
 
 
 # Get all specifications of a Product with id = product_id
 @router.get("/values/{product_id}",  status_code=status.HTTP_200_OK)
-async def get_product_specifications(product_id: int, db: db_dependency): 
+async def get_product_specifications(product_id: int, db: read_db_dependency): 
 
     p_specifications = (
-        db.query(ProductSpecification)
-        .join(Specification, ProductSpecification.specification_id == Specification.id)
-        .filter(ProductSpecification.product_id == product_id)
-        .options(joinedload(ProductSpecification.specification)) 
-        .all()
+        await db.scalars(
+            select(ProductSpecification)
+            .join(Specification, ProductSpecification.specification_id == Specification.id)
+            .where(ProductSpecification.product_id == product_id)
+            .options(joinedload(ProductSpecification.specification))
+        )
     )
 
     data = [
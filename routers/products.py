@@ -1,21 +1,38 @@
 from typing import List, Annotated, Optional
-from fastapi import APIRouter, Query, Depends, HTTPException, status, Response # type: ignore
+from fastapi import APIRouter, Query, Depends, HTTPException, status, Response, Request, File, UploadFile # type: ignore
+from fastapi.responses import StreamingResponse
 
-from sqlalchemy.orm import Session # type: ignore
+from sqlalchemy.orm import joinedload, selectinload, noload # type: ignore
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql.expression import text # type: ignore
-from sqlalchemy import and_
+from sqlalchemy import select, insert, delete, and_, or_, case, func, true
+from sqlalchemy.exc import SQLAlchemyError
 
+import csv
+import io
 import logging
+import os
+import orjson
 
 import pytz
 from datetime import datetime, timedelta
 
-from redis import Redis
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
-from .utils.services import get_redis, fill_cache_products, check_filters_products
-from database import sessionLocal
-from models import Product, Category, Brand, User, ProductSpecification, Image
-from schemas import ProductCreate, ProductResponse, ProductUpdate
+from .utils.services import get_redis, product_cache_keys, make_etag, conditional_headers, is_not_modified, check_filters_products, normalize_filters_products, namespaces_products, serialize_products, \
+    encode_cursor, decode_cursor, pack_products_page, unpack_products_page, search_products, \
+    get_cached_products, fill_cache_products, evict_cached_products, parse_spec_filters, spec_filter_products, product_namespaces
+from .utils.category_tree import category_descendants, category_ancestors
+from .utils.counters import get_counter, update_counters, product_counter_fields, reconcile_counters
+from .utils.suggest import get_suggestions, update_suggestions, product_suggestion_members, rebuild_suggestions
+from .utils.imports import import_format, iter_import_rows, validate_import_row, IMPORT_BATCH_SIZE
+from .utils.cache import make_key, cache_get, cache_set, cache_set_many, get_generations, bump_generations, replica_fill_blocked, category_ns, brand_ns, PRODUCTS, SPECS, \
+    PRODUCTS_CACHE_TTL, PRODUCT_CACHE_TTL, FACETS_CACHE_TTL
+from database import db_dependency, read_db_dependency, replicaSessionLocal
+from models import Product, Category, Brand, User, ProductSpecification, Image, ImageVariant
+from schemas import ProductCreate, ProductResponse, ProductUpdate, SuggestionResponse, ProductFacetsResponse, ProductBatchResponse, \
+    ProductDetailResponse, ProductImportResponse
 
 
 
@@ -24,31 +41,56 @@ router = APIRouter(
     tags=["products"]
 )
 
-def get_db():
-    db = sessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 redis_dependency = Annotated[Redis, Depends(get_redis)]
 logger = logging.getLogger("uvicorn.error")
 TIMEZONE = pytz.timezone("Asia/Baku")
 
+MAX_BATCH_IDS = 300
+
+# Lower bounds of the price facet buckets, the last one is open-ended
+PRICE_BUCKETS = [int(edge) for edge in os.getenv("PRICE_BUCKETS", "0,100,250,500,1000,2500,5000").split(",")]
+
+# Rows fetched per round trip from the server-side cursor of /export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+# CSV is flat, image variants only go out in NDJSON
+EXPORT_FIELDS = [name for name in ProductResponse.model_fields if name != "image_variants"]
+
+
+def products_page_response(payload: bytes, next_cursor: Optional[str] = None):
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+
+async def category_filter_products(db, redis, category_id):
+    # The category and all its descendants, from the cached tree
+    category_ids = await category_descendants(db, redis, category_id)
+    logger.info(f"Category IDs: {category_ids}")
+    return Product.category_id.in_(category_ids)
+
+
 @router.get("/num-products", status_code=status.HTTP_200_OK)
-async def get_num_products(db: db_dependency):
-    num_products = db.query(Product).count()
+async def get_num_products(db: read_db_dependency, redis: redis_dependency):
+    num_products = await get_counter(db, redis, "total")
     return num_products
 
 @router.get("/num-products-new", status_code=status.HTTP_200_OK)
-async def get_num_products(db: db_dependency):
-    num_products = db.query(Product).filter(Product.is_new).count()
+async def get_num_products(db: read_db_dependency, redis: redis_dependency):
+    num_products = await get_counter(db, redis, "new")
+    return num_products
+
+@router.get("/num-products/category/{category_id}", status_code=status.HTTP_200_OK)
+async def get_num_products_category(category_id: int, db: read_db_dependency, redis: redis_dependency):
+    num_products = await get_counter(db, redis, f"category:{category_id}")
+    return num_products
+
+@router.get("/num-products/brand/{brand_id}", status_code=status.HTTP_200_OK)
+async def get_num_products_brand(brand_id: int, db: read_db_dependency, redis: redis_dependency):
+    num_products = await get_counter(db, redis, f"brand:{brand_id}")
     return num_products
 
 @router.get("", response_model=List[ProductResponse], status_code=status.HTTP_200_OK)
 async def get_all_products(
-    db: db_dependency, 
+    db: read_db_dependency, 
     redis: redis_dependency,
     category_id: Optional[int] = Query(None), 
     brand_id: Optional[int] = Query(None),
@@ -57,119 +99,353 @@ async def get_all_products(
     max_price: Optional[float] = Query(None),
     search_query: Optional[str] = Query(None),
     page: Optional[int] = Query(None, ge=1), 
-    page_size: Optional[int] = Query(None, ge=1, le=100)
+    page_size: Optional[int] = Query(None, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    spec: Optional[List[str]] = Query(None, description="<specification_id>:<value>, repeatable")
 ):
-    logger.info(f"Request: page={page}, page_size={page_size}")
-    try:
-        # Clear Redis cache before every request
-        redis.flushall()
-        logger.info("Redis cache cleared")
-
-        if (page and page_size):
-            offset = (page - 1) * page_size
-        else:
-            offset = 0
-        
-        # Since Redis is cleared, skip the caching check
-        if search_query:
-            query = db.query(Product).filter(Product.search_string.ilike(f"%{search_query}%"))\
-                .order_by(text("date_created DESC"))\
-                .offset(offset)
-            products = query.limit(page_size).all() if page_size else query.all()
-            logger.info(f"Search query, fetched {len(products)} products")
-            fill_cache_products(products, redis)
-            return products
-
-        else:
-            if category_id:
-                categories = db.query(Category).filter(Category.parent_category_id == category_id).all()
-                category_ids = [category.id for category in categories]
-                category_ids.append(category_id)
-                logger.info(f"Category IDs: {category_ids}")
-            filters = check_filters_products(brand_id, available, discount, max_price)
-            logger.info(f"Filters applied: {filters}")
-            
-            if category_id:
-                query = db.query(Product).filter(Product.category_id.in_(category_ids), *filters)\
-                    .order_by(text("date_created DESC"))\
-                    .offset(offset)
-            else:
-                query = db.query(Product).filter(and_(*filters))\
-                    .order_by(text("date_created DESC"))\
-                    .offset(offset)
-            
-            logger.info(f"Query: {str(query)}")
-            products = query.limit(page_size).all() if page_size else query.all()
-            logger.info(f"Fetched {len(products)} products")
-            fill_cache_products(products, redis)
-            return products
-    
-    except Exception as e:
-        logger.error(f"Exception: {str(e)}")
-        # Clear Redis in case of exception too
-        redis.flushall()
-        logger.info("Redis cache cleared in exception block")
-        # Repeat logic
-        if category_id:
-            categories = db.query(Category).filter(Category.parent_category_id == category_id).all()
-            category_ids = [category.id for category in categories]
-            category_ids.append(category_id)
+    # Keyset pagination is opt-in: pass cursor= (empty) for the first page and
+    # then the X-Next-Cursor header of each response, which is absent on the last page
+    logger.info(f"Request: page={page}, page_size={page_size}, cursor={cursor}")
+
+    seek = None
+    if cursor:
+        seek = decode_cursor(cursor)
+        if not seek:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    specs = parse_spec_filters(spec)
+    if specs is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Spec filters must look like <specification_id>:<value>")
+
+    params = normalize_filters_products(
+        category_id, brand_id, available, discount, max_price, search_query, page, page_size, cursor, specs
+    )
+    namespaces = namespaces_products(params)
+    generations = await get_generations(redis, namespaces)
+    cache_key = make_key("products:list", {**params, "gen": generations}) if generations else None
+
+    cached = await cache_get(redis, cache_key) if cache_key else None
+    if cached is not None:
+        logger.info(f"Cache hit: {cache_key}")
+        payload, next_cursor = unpack_products_page(cached)
+        return products_page_response(payload, next_cursor)
+
+    if params["page"]:
+        offset = (params["page"] - 1) * params["page_size"]
+    else:
+        offset = 0
+
+    relevance = None
+    if params["search_query"]:
+        search_filter, relevance = search_products(params["search_query"])
+        query = select(Product).where(search_filter)
+    else:
         filters = check_filters_products(brand_id, available, discount, max_price)
+        logger.info(f"Filters applied: {filters}")
+
         if category_id:
-            query = db.query(Product).filter(Product.category_id.in_(category_ids), *filters)\
-                .order_by(text("date_created DESC"))\
-                .offset(offset)
-        else:
-            query = db.query(Product).filter(and_(*filters))\
-                .order_by(text("date_created DESC"))\
-                .offset(offset)
-        products = query.limit(page_size).all() if page_size else query.all()
-        logger.info(f"Exception block fetched {len(products)} products")
-        fill_cache_products(products, redis)
-        return products
+            filters.append(await category_filter_products(db, redis, category_id))
+        if specs:
+            filters.append(spec_filter_products(specs))
+
+        query = select(Product).where(and_(*filters))
+    query = query.options(selectinload(Product.image_variants))
+
+    next_cursor = None
+    if params["cursor"] is not None:
+        if seek:
+            created, last_id = seek
+            query = query.where(or_(
+                Product.date_created < created,
+                and_(Product.date_created == created, Product.id < last_id),
+            ))
+        # One extra row tells whether there is a next page
+        products = (await db.scalars(
+            query.order_by(Product.date_created.desc(), Product.id.desc()).limit(params["page_size"] + 1)
+        )).all()
+        if len(products) > params["page_size"]:
+            products = products[:params["page_size"]]
+            next_cursor = encode_cursor(products[-1])
+    else:
+        if relevance is not None:
+            # Best matches first, newest first among equally relevant ones
+            query = query.order_by(relevance.desc())
+        query = query.order_by(text("date_created DESC")).offset(offset)
+        if page_size:
+            query = query.limit(page_size)
+        products = (await db.scalars(query)).all()
+    logger.info(f"Fetched {len(products)} products")
+
+    payload = serialize_products(products)
+    if cache_key and not await replica_fill_blocked(redis, db, *namespaces):
+        await cache_set(redis, cache_key, pack_products_page(payload, next_cursor), PRODUCTS_CACHE_TTL)
+    return products_page_response(payload, next_cursor)
 
 
 @router.get("/new-arrivals", response_model=List[ProductResponse], status_code=status.HTTP_200_OK)
 async def get_new_products(
-        db: db_dependency,
+        db: read_db_dependency,
     ):
 
-    products = db.query(
+    products = (await db.scalars(select(
         Product
-        ).filter(Product.date_created > (datetime.now() - timedelta(days=7))
+        ).options(selectinload(Product.image_variants)
+        ).where(Product.date_created > (datetime.now() - timedelta(days=7))
         ).order_by(text("date_created DESC")
-        ).limit(10).all()
+        ).limit(10))).all()
     
     return products
 
 @router.get("/is_super", response_model=List[ProductResponse], status_code=status.HTTP_200_OK)
 async def get_super_products(
-        db: db_dependency,
+        db: read_db_dependency,
     ):
 
-    products = db.query(
+    products = (await db.scalars(select(
         Product
-        ).filter(Product.is_super
+        ).options(selectinload(Product.image_variants)
+        ).where(Product.is_super
         ).order_by(text("date_created DESC")
-        ).limit(10).all()
+        ).limit(10))).all()
     
     return products
 
 
 
+@router.get("/facets", response_model=ProductFacetsResponse, status_code=status.HTTP_200_OK)
+async def get_product_facets(
+    db: read_db_dependency,
+    redis: redis_dependency,
+    category_id: Optional[int] = Query(None),
+    brand_id: Optional[int] = Query(None),
+    available: Optional[bool] = Query(None),
+    discount: Optional[bool] = Query(None),
+    max_price: Optional[float] = Query(None)
+):
+    # Each facet is counted with every filter except its own one, so the
+    # sidebar shows what selecting another value would give
+    params = normalize_filters_products(category_id, brand_id, available, discount, max_price)
+    # Brand counts span all brands, so only the category narrows the namespace
+    namespaces = namespaces_products({**params, "brand_id": None})
+    generations = await get_generations(redis, namespaces)
+    cache_key = make_key("products:facets", {**params, "gen": generations}) if generations else None
+
+    cached = await cache_get(redis, cache_key) if cache_key else None
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    category_filters = [await category_filter_products(db, redis, category_id)] if category_id else []
+
+    in_stock = Product.num_product > 0
+    discounted = Product.discount > 0
+    available_cond = in_stock if available else true()
+    discount_cond = discounted if discount else true()
+    price_cond = Product.price <= max_price if max_price else true()
+
+    def count_where(*conditions):
+        return func.coalesce(func.sum(case((and_(*conditions), 1), else_=0)), 0)
+
+    bounds = list(zip(PRICE_BUCKETS, PRICE_BUCKETS[1:] + [None]))
+    bucket_columns = [
+        count_where(Product.price >= low, *([Product.price < high] if high is not None else []), available_cond, discount_cond)
+        for low, high in bounds
+    ]
+    totals = (await db.execute(select(
+        count_where(available_cond, discount_cond, price_cond),
+        count_where(in_stock, discount_cond, price_cond),
+        count_where(discounted, available_cond, price_cond),
+        *bucket_columns,
+    ).where(*check_filters_products(brand_id, None, None, None), *category_filters))).one()
+
+    brands = (await db.execute(select(Product.brend_id, func.count(Product.id))\
+        .where(*check_filters_products(None, available, discount, max_price), *category_filters)\
+        .group_by(Product.brend_id))).all()
+
+    categories = (await db.execute(select(Product.category_id, func.count(Product.id))\
+        .where(*check_filters_products(brand_id, available, discount, max_price), *category_filters)\
+        .group_by(Product.category_id))).all()
+
+    facets = ProductFacetsResponse(
+        total=totals[0],
+        in_stock=totals[1],
+        discounted=totals[2],
+        brands=[{"id": facet_id, "count": count} for facet_id, count in brands],
+        categories=[{"id": facet_id, "count": count} for facet_id, count in categories],
+        price_buckets=[
+            {"min": low, "max": high, "count": count}
+            for (low, high), count in zip(bounds, totals[3:])
+        ],
+    )
+    payload = facets.model_dump_json().encode()
+    if cache_key and not await replica_fill_blocked(redis, db, *namespaces):
+        await cache_set(redis, cache_key, payload, FACETS_CACHE_TTL)
+    return Response(content=payload, media_type="application/json")
+
+
+@router.get("/suggest", response_model=List[SuggestionResponse], status_code=status.HTTP_200_OK)
+async def get_product_suggestions(
+    db: read_db_dependency,
+    redis: redis_dependency,
+    q: str = Query(..., min_length=1, max_length=64),
+    limit: int = Query(8, ge=1, le=20)
+):
+    return await get_suggestions(db, redis, q, limit)
+
+
+async def attach_image_variants(db, products):
+    # Loads variants for one chunk of a streamed query. db must not be the
+    # streaming session: a second query on that connection would make the
+    # driver discard the rest of the server-side cursor.
+    db.expunge_all()
+    links = {product.image_link for product in products if product.image_link}
+    variants = {}
+    if links:
+        for variant in await db.scalars(select(ImageVariant).where(ImageVariant.source_link.in_(links))):
+            variants.setdefault(variant.source_link, []).append(variant)
+    for product in products:
+        set_committed_value(product, "image_variants", variants.get(product.image_link, []))
+
+
+async def export_products_chunks(file_format: str):
+    # Runs while the response streams, after the request's own session is
+    # closed, so it opens its own. The identity map only holds weak references,
+    # so a chunk is freed once it is written out.
+    async with replicaSessionLocal() as db, replicaSessionLocal() as variants_db:
+        query = select(Product).order_by(Product.id).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        if file_format == "csv":
+            # CSV has no column for them, NDJSON attaches them per chunk
+            query = query.options(noload(Product.image_variants))
+        result = await db.stream_scalars(query)
+        if file_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            yield buffer.getvalue().encode()
+
+        async for products in result.partitions():
+            if file_format == "csv":
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(ProductResponse.model_validate(product).model_dump(mode="json") for product in products)
+                yield buffer.getvalue().encode()
+            else:
+                await attach_image_variants(variants_db, products)
+                yield b"".join(ProductResponse.model_validate(product).model_dump_json().encode() + b"\n" for product in products)
+
+
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_products(file_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$")):
+    # The whole catalog in ProductResponse fields, streamed as it is read
+    media_type = "text/csv" if file_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_products_chunks(file_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{file_format}"'},
+    )
+
+
+@router.get("/batch", response_model=ProductBatchResponse, status_code=status.HTTP_200_OK)
+async def get_products_batch(
+    db: read_db_dependency,
+    redis: redis_dependency,
+    ids: List[str] = Query(...)
+):
+    # Accepts ids=1,2,3 as well as ids=1&ids=2&ids=3
+    try:
+        requested = [int(product_id) for value in ids for product_id in value.split(",") if product_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Product ids must be integers")
+    product_ids = list(dict.fromkeys(requested))
+    if len(product_ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BATCH_IDS} product ids per request"
+        )
+
+    found = await get_cached_products(redis, product_ids)
+    misses = [product_id for product_id in product_ids if product_id not in found]
+    if misses:
+        products = (await db.scalars(
+            select(Product).options(selectinload(Product.image_variants)).where(Product.id.in_(misses))
+        )).all()
+        found.update(await fill_cache_products(products, redis, db))
+
+    # Cached entries are already JSON, so the body is assembled, not re-serialized
+    missing = [product_id for product_id in product_ids if product_id not in found]
+    payload = b'{"products":[' + b",".join(found[product_id] for product_id in product_ids if product_id in found) \
+        + b'],"missing":' + orjson.dumps(missing) + b"}"
+    return Response(content=payload, media_type="application/json")
+
+
 @router.get("/{product_id}", response_model=ProductResponse, status_code=status.HTTP_200_OK)
-async def get_product(product_id: int, db: db_dependency): # type: ignore
-    product = db.query(Product).filter(Product.id == product_id).first()
+async def get_product(product_id: int, request: Request, db: read_db_dependency, redis: redis_dependency): # type: ignore
+    cached = await get_cached_products(redis, [product_id])
+    if product_id in cached:
+        payload = cached[product_id]
+    else:
+        product = await db.get(Product, product_id, options=[selectinload(Product.image_variants)])
+        if not product:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+        payload = (await fill_cache_products([product], redis, db))[product_id]
+
+    # Validators come from the serialized body, no query needed on a cache hit
+    updated_at = datetime.fromisoformat(orjson.loads(payload)["updated_at"])
+    headers = conditional_headers(make_etag("product", payload), updated_at)
+    if is_not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+
+@router.get("/{product_id}/full", response_model=ProductDetailResponse, status_code=status.HTTP_200_OK)
+async def get_product_full(product_id: int, db: read_db_dependency, redis: redis_dependency): # type: ignore
+    # Everything a product page needs: brand, category, images and specifications
+    cached = await get_cached_products(redis, [product_id], "product:full")
+    if product_id in cached:
+        return Response(content=cached[product_id], media_type="application/json")
+
+    # Two queries: product with brand, category and images joined, then
+    # the specifications with their names
+    product = (await db.scalars(select(Product)\
+        .options(
+            joinedload(Product.brend),
+            joinedload(Product.category),
+            joinedload(Product.images),
+            selectinload(Product.image_variants),
+            selectinload(Product.specifications).joinedload(ProductSpecification.specification),
+        )\
+        .where(Product.id == product_id)
+    )).unique().first()
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    return product
+
+    detail = ProductDetailResponse.model_validate({
+        **ProductResponse.model_validate(product).model_dump(),
+        "brend": product.brend,
+        "category": product.category,
+        "images": product.images,
+        "specifications": [
+            {
+                "id": p_specification.id,
+                "specification_id": p_specification.specification_id,
+                "name": p_specification.specification.name,
+                "value": p_specification.value,
+            }
+            for p_specification in product.specifications
+        ],
+    }, from_attributes=True)
+    payload = detail.model_dump_json().encode()
+
+    keys = await product_cache_keys(redis, [product_id], "product:full")
+    if keys and not await replica_fill_blocked(redis, db, f"product:{product_id}"):
+        await cache_set_many(redis, {keys[0]: payload}, PRODUCT_CACHE_TTL)
+    return Response(content=payload, media_type="application/json")
 
 
 @router.post("/add", response_model=ProductResponse, status_code=status.HTTP_201_CREATED)
 async def create_product(product_data: ProductCreate, db: db_dependency, redis: redis_dependency): # type: ignore
     new_product = Product(**product_data.dict())
     
-    category = db.query(Category).filter(Category.id == product_data.category_id).first()
+    category = await db.get(Category, product_data.category_id)
     if not category:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -177,24 +453,110 @@ async def create_product(product_data: ProductCreate, db: db_dependency, redis:
         )
     
     # Checking brend_id
-    brend = db.query(Brand).filter(Brand.id == product_data.brend_id).first()
+    brend = await db.get(Brand, product_data.brend_id)
     if not brend:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Brend with id {product_data.brend_id} does not exist."
         )
     db.add(new_product)
-    db.commit()
-    db.refresh(new_product)
+    await db.commit()
+    await db.refresh(new_product)
+    await db.refresh(new_product, ["image_variants"])
 
-    redis.flushall()
+    await bump_generations(redis, *await product_namespaces(db, redis, new_product))
+    await update_suggestions(redis, added=await product_suggestion_members(db, new_product))
+    await update_counters(redis, added=product_counter_fields(new_product))
     return new_product
 
 
+@router.post("/import", response_model=ProductImportResponse, status_code=status.HTTP_200_OK)
+async def import_products(
+    db: db_dependency,
+    redis: redis_dependency,
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Query(None, alias="format", pattern="^(csv|jsonl)$")
+):
+    # Same fields as /add, one product per CSV row or JSON line. Valid rows are
+    # inserted, invalid ones are reported by line number.
+    file_format = file_format or import_format(file.filename)
+    if not file_format:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Upload a .csv or .jsonl file, or pass format=csv|jsonl"
+        )
+
+    category_ids = set((await db.scalars(select(Category.id))).all())
+    brand_ids = set((await db.scalars(select(Brand.id))).all())
+    user_ids = set((await db.scalars(select(User.id))).all())
+
+    errors = []
+    inserted = 0
+    # What the inserted products are listed under, for cache invalidation
+    inserted_category_ids = set()
+    inserted_brand_ids = set()
+
+    async def insert_rows(rows):
+        nonlocal inserted
+        await db.execute(insert(Product), [values for _, values in rows])
+        await db.commit()
+        inserted += len(rows)
+        inserted_category_ids.update(values["category_id"] for _, values in rows)
+        inserted_brand_ids.update(values["brend_id"] for _, values in rows)
+
+    async def insert_batch(batch):
+        try:
+            await insert_rows(batch)
+            return
+        except SQLAlchemyError as e:
+            await db.rollback()
+            logger.warning(f"Product import batch failed, retrying its rows one by one: {e}")
+        # Only the rows the database rejects are reported, the rest go in
+        for row, values in batch:
+            try:
+                await insert_rows([(row, values)])
+            except SQLAlchemyError as e:
+                await db.rollback()
+                errors.append({"row": row, "errors": [f"Insert failed: {getattr(e, 'orig', e)}"]})
+
+    batch = []
+    for row, record, error in iter_import_rows(file.file, file_format):
+        values, row_errors = validate_import_row(record, category_ids, brand_ids, user_ids) if record is not None else (None, [error])
+        if row_errors:
+            errors.append({"row": row, "errors": row_errors})
+            continue
+        batch.append((row, values))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await insert_batch(batch)
+            batch = []
+    if batch:
+        await insert_batch(batch)
+    logger.info(f"Product import: {inserted} inserted, {len(errors)} failed")
+
+    if inserted:
+        # Invalidate once for the whole file instead of once per product
+        namespaces = {PRODUCTS}
+        for category_id in inserted_category_ids:
+            namespaces.add(category_ns(category_id))
+            namespaces.update(category_ns(ancestor_id) for ancestor_id in await category_ancestors(db, redis, category_id))
+        namespaces.update(brand_ns(brand_id) for brand_id in inserted_brand_ids)
+        await bump_generations(redis, *namespaces)
+
+        # Incremental updates are per product, a full rebuild is cheaper here
+        try:
+            await reconcile_counters(db, redis)
+            await rebuild_suggestions(db, redis)
+        except RedisError as e:
+            logger.warning(f"Redis refresh after product import failed: {e}")
+
+    errors.sort(key=lambda error: error["row"])
+    return {"inserted": inserted, "failed": len(errors), "errors": errors}
+
+
 @router.put("/{product_id}", response_model=ProductResponse, status_code=status.HTTP_200_OK)
 async def update_product(product_id: int, product_data: ProductUpdate, db: db_dependency, redis: redis_dependency):
 
-    product = db.query(Product).filter(Product.id == product_id).first()
+    product = await db.get(Product, product_id)
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
 
@@ -202,7 +564,7 @@ async def update_product(product_id: int, product_data: ProductUpdate, db: db_de
     update_data = product_data.dict(exclude_unset=True)
 
     if "category_id" in update_data:
-        category = db.query(Category).filter(Category.id == update_data["category_id"]).first()
+        category = await db.get(Category, update_data["category_id"])
         if not category:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -210,38 +572,54 @@ async def update_product(product_id: int, product_data: ProductUpdate, db: db_de
             )
 
     if "brend_id" in update_data:
-        brend = db.query(Brand).filter(Brand.id == update_data["brend_id"]).first()
+        brend = await db.get(Brand, update_data["brend_id"])
         if not brend:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Brend with id {update_data['brend_id']} does not exist."
             )
 
-    db.execute(text("UNLOCK TABLES;"))
-    
+    await db.execute(text("UNLOCK TABLES;"))
+
+    # Old category and brand listings lose the product if those change
+    namespaces = await product_namespaces(db, redis, product)
+    old_suggestions = await product_suggestion_members(db, product)
+    old_counters = product_counter_fields(product)
+
     for key, value in update_data.items():
         setattr(product, key, value)
 
     product.updated_at = datetime.now(TIMEZONE)
 
-    db.commit()
-    db.refresh(product)
+    await db.commit()
+    await db.refresh(product)
+    await db.refresh(product, ["image_variants"])
 
-    redis.flushall()
+    await bump_generations(redis, *namespaces, *await product_namespaces(db, redis, product))
+    await evict_cached_products(redis, [product_id])
+    await update_suggestions(redis, added=await product_suggestion_members(db, product), removed=old_suggestions)
+    await update_counters(redis, added=product_counter_fields(product), removed=old_counters)
     return product
 
 
 
 @router.delete("/{product_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_product(product_id: int, db: db_dependency, redis: redis_dependency):  # type: ignore
-    db.query(ProductSpecification).filter(ProductSpecification.product_id == product_id).delete()
+    await db.execute(delete(ProductSpecification).where(ProductSpecification.product_id == product_id))
 
-    product = db.query(Product).filter(Product.id == product_id).first()
+    product = await db.get(Product, product_id)
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
 
-    db.delete(product)
-    db.commit()
-    redis.flushall()
+    namespaces = await product_namespaces(db, redis, product)
+    old_suggestions = await product_suggestion_members(db, product)
+    old_counters = product_counter_fields(product)
+    await db.delete(product)
+    await db.commit()
+    # Its specification rows went with it
+    await bump_generations(redis, *namespaces, SPECS)
+    await evict_cached_products(redis, [product_id])
+    await update_suggestions(redis, removed=old_suggestions)
+    await update_counters(redis, removed=old_counters)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import os
+
+import orjson
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.exceptions import RedisError
+
+from database import replica_engine, REPLICA_PIN_SECONDS
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Vars
+
+PRODUCTS_CACHE_TTL = int(os.getenv("PRODUCTS_CACHE_TTL", 300))
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 600))
+FACETS_CACHE_TTL = int(os.getenv("FACETS_CACHE_TTL", PRODUCTS_CACHE_TTL))
+CATEGORY_TREE_TTL = int(os.getenv("CATEGORY_TREE_TTL", 24 * 60 * 60))
+
+# Connection pool of the shared client, per worker process. A request waits
+# up to REDIS_POOL_TIMEOUT for a free connection instead of failing at once.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 2))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 1))
+
+# Cache namespaces. Every cached entry embeds the current generation of the
+# namespaces it depends on, so bumping a generation orphans those entries
+# and they expire on their own TTL instead of being deleted.
+CATALOG = "catalog"     # everything, bumped by /others/cache/clear
+PRODUCTS = "products"   # listings not narrowed by category or brand
+CATEGORIES = "categories"   # the category tree, bumped by category writes
+SPECS = "specs"         # listings filtered by specification values
+
+# A write leaves a "written:<name>" marker for as long as the replica may lag
+# behind it. Entries read from the replica are not cached while one of their
+# markers is set, so they cannot pin stale rows under the new generation.
+# Without a replica every read is on the primary and no marker is needed.
+REPLICA_LAG_SECONDS = REPLICA_PIN_SECONDS if replica_engine else 0
+
+
+# Functions
+
+def create_redis(url: str):
+    pool = BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=30,
+    )
+    # The client owns the pool, so aclose() disconnects it too
+    return Redis.from_pool(pool)
+
+
+def category_ns(category_id: int):
+    return f"category:{category_id}"
+
+
+def brand_ns(brand_id: int):
+    return f"brand:{brand_id}"
+
+
+async def get_generations(redis: Redis, namespaces: list):
+    try:
+        values = await redis.mget([f"gen:{ns}" for ns in namespaces])
+    except RedisError as e:
+        logger.warning(f"Redis mget failed for generations {namespaces}: {e}")
+        return None
+    return {ns: int(value or 0) for ns, value in zip(namespaces, values)}
+
+
+async def bump_generations(redis: Redis, *namespaces: str, strict: bool = False):
+    # Writes are already committed when this runs, so by default a Redis
+    # failure is only logged and stale entries live until their TTL
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for ns in set(namespaces):
+            pipe.incr(f"gen:{ns}")
+            if REPLICA_LAG_SECONDS:
+                pipe.set(f"written:{ns}", 1, ex=REPLICA_LAG_SECONDS)
+        await pipe.execute()
+    except RedisError as e:
+        if strict:
+            raise
+        logger.warning(f"Redis generation bump failed for {namespaces}: {e}")
+
+
+async def mark_written(redis: Redis, *names: str):
+    # For entries invalidated by deletion rather than a generation bump
+    if not REPLICA_LAG_SECONDS or not names:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for name in names:
+            pipe.set(f"written:{name}", 1, ex=REPLICA_LAG_SECONDS)
+        await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Redis write markers failed for {names}: {e}")
+
+
+async def replica_fill_blocked(redis: Redis, db, *names: str):
+    # True when db reads the replica and one of names was written too recently
+    # for the replica to be trusted with it. Callers then serve without caching.
+    if not REPLICA_LAG_SECONDS or db.bind is not replica_engine:
+        return False
+    try:
+        return bool(await redis.exists(*(f"written:{name}" for name in names)))
+    except RedisError as e:
+        logger.warning(f"Redis exists failed for write markers {names}: {e}")
+        return True
+
+
+def make_key(prefix: str, params: dict):
+    # Same filters always give the same key, whatever the query string order
+    raw = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+    return f"{prefix}:{hashlib.sha1(raw).hexdigest()}"
+
+
+async def cache_get(redis: Redis, key: str):
+    # Redis being down must never break a read, just fall through to the DB
+    try:
+        return await redis.get(key)
+    except RedisError as e:
+        logger.warning(f"Redis get failed for {key}: {e}")
+        return None
+
+
+async def cache_set(redis: Redis, key: str, value: bytes, ttl: int):
+    try:
+        await redis.set(key, value, ex=ttl)
+    except RedisError as e:
+        logger.warning(f"Redis set failed for {key}: {e}")
+
+
+async def cache_get_many(redis: Redis, keys: list):
+    if not keys:
+        return []
+    try:
+        return await redis.mget(keys)
+    except RedisError as e:
+        logger.warning(f"Redis mget failed for {len(keys)} keys: {e}")
+        return [None] * len(keys)
+
+
+async def cache_set_many(redis: Redis, values: dict, ttl: int):
+    if not values:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(key, value, ex=ttl)
+        await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Redis set failed for {len(values)} keys: {e}")
+
+
+async def cache_delete(redis: Redis, *keys: str):
+    if not keys:
+        return
+    try:
+        await redis.delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Redis delete failed for {keys}: {e}")
@@ -0,0 +1,111 @@
+import logging
+
+import orjson
+from redis.asyncio import Redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.expression import text
+
+from database import asyncSessionLocal
+from models import Category
+from schemas import CategoryResponse
+from .cache import make_key, cache_get, cache_set, get_generations, CATALOG, CATEGORIES, CATEGORY_TREE_TTL
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Vars
+
+# Parsed tree of the current generation, so most requests only pay for the
+# generation lookup. Holds a single entry, older generations are dropped.
+_tree_memo = {}
+
+
+# Functions
+
+async def build_category_tree(db: AsyncSession):
+    categories = (await db.scalars(select(Category).order_by(text("date_created DESC")))).all()
+    by_id = {category.id: category for category in categories}
+
+    children = {}
+    for category in categories:
+        parent_id = category.parent_category_id if category.parent_category_id in by_id else None
+        children.setdefault(parent_id, []).append(category.id)
+
+    descendants = {}
+    ancestors = {category_id: [] for category_id in by_id}
+
+    def walk(category_id, path):
+        # path guards against a parent cycle in bad data
+        closure = [category_id]
+        for child_id in children.get(category_id, []):
+            if child_id in path:
+                continue
+            ancestors[child_id] = [category_id, *ancestors[category_id]]
+            closure.extend(walk(child_id, path | {child_id}))
+        descendants[category_id] = closure
+        return closure
+
+    def node(category_id):
+        data = CategoryResponse.model_validate(by_id[category_id]).model_dump(mode="json")
+        data["children"] = [node(child_id) for child_id in children.get(category_id, [])]
+        return data
+
+    roots = children.get(None, [])
+    for root_id in roots:
+        walk(root_id, {root_id})
+
+    return {
+        "tree": [node(root_id) for root_id in roots],
+        "descendants": descendants,
+        "ancestors": ancestors,
+    }
+
+
+def _load(data: dict):
+    # JSON object keys come back as strings
+    return {
+        "tree": orjson.dumps(data["tree"]),
+        "descendants": {int(k): v for k, v in data["descendants"].items()},
+        "ancestors": {int(k): v for k, v in data["ancestors"].items()},
+    }
+
+
+async def get_category_tree(db: AsyncSession, redis: Redis):
+    generations = await get_generations(redis, [CATALOG, CATEGORIES])
+    if not generations:
+        return _load(await build_category_tree(db))
+
+    cache_key = make_key("categories:tree", generations)
+    if cache_key in _tree_memo:
+        return _tree_memo[cache_key]
+
+    cached = await cache_get(redis, cache_key)
+    if cached is None:
+        # Always from the primary: db may be a lagging replica, and the tree
+        # is shared by every worker for CATEGORY_TREE_TTL
+        async with asyncSessionLocal() as primary_db:
+            raw = orjson.dumps(await build_category_tree(primary_db), option=orjson.OPT_NON_STR_KEYS)
+        await cache_set(redis, cache_key, raw, CATEGORY_TREE_TTL)
+        logger.info(f"Category tree rebuilt: {cache_key}")
+    else:
+        raw = cached
+
+    tree = _load(orjson.loads(raw))
+    _tree_memo.clear()
+    _tree_memo[cache_key] = tree
+    return tree
+
+
+async def category_descendants(db: AsyncSession, redis: Redis, category_id: int):
+    return (await get_category_tree(db, redis))["descendants"].get(category_id, [category_id])
+
+
+async def category_ancestors(db: AsyncSession, redis: Redis, category_id: int):
+    return (await get_category_tree(db, redis))["ancestors"].get(category_id, [])
+
+
+async def warm_category_tree(redis: Redis, session_factory):
+    async with session_factory() as db:
+        await get_category_tree(db, redis)
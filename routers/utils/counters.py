@@ -0,0 +1,97 @@
+import logging
+from collections import Counter
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy import select, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Product
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Vars
+
+# One hash holds every product counter: "total", "new", "category:<id>"
+# and "brand:<id>". Writes adjust it with HINCRBY, reads are a single HGET,
+# and reconcile_counters rebuilds it from the database to correct drift.
+COUNTERS_KEY = "counters:products"
+
+
+# Functions
+
+def product_counter_fields(product):
+    fields = ["total", f"category:{product.category_id}", f"brand:{product.brend_id}"]
+    if product.is_new:
+        fields.append("new")
+    return fields
+
+
+async def update_counters(redis: Redis, added=(), removed=()):
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    try:
+        # Only adjust a hash that exists, a missing one is rebuilt on next read
+        if not await redis.exists(COUNTERS_KEY):
+            return
+        pipe = redis.pipeline(transaction=False)
+        for field, delta in deltas.items():
+            pipe.hincrby(COUNTERS_KEY, field, delta)
+        await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Redis counter update failed: {e}")
+
+
+async def count_products(db: AsyncSession):
+    total, new = (await db.execute(select(
+        func.count(Product.id),
+        func.coalesce(func.sum(case((Product.is_new, 1), else_=0)), 0),
+    ))).one()
+    counters = {"total": total, "new": int(new)}
+    rows = await db.execute(select(Product.category_id, func.count(Product.id)).group_by(Product.category_id))
+    for category_id, count in rows:
+        counters[f"category:{category_id}"] = count
+    rows = await db.execute(select(Product.brend_id, func.count(Product.id)).group_by(Product.brend_id))
+    for brand_id, count in rows:
+        counters[f"brand:{brand_id}"] = count
+    return counters
+
+
+async def reconcile_counters(db: AsyncSession, redis: Redis):
+    counters = await count_products(db)
+    # Built aside and swapped in, readers never see a partial hash
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(f"{COUNTERS_KEY}:next")
+    pipe.hset(f"{COUNTERS_KEY}:next", mapping=counters)
+    pipe.rename(f"{COUNTERS_KEY}:next", COUNTERS_KEY)
+    await pipe.execute()
+    logger.info(f"Product counters reconciled: {len(counters)} fields")
+    return counters
+
+
+async def reconcile_counters_job(redis: Redis, session_factory):
+    # Periodic job, see main.lifespan
+    async with session_factory() as db:
+        try:
+            await reconcile_counters(db, redis)
+        except RedisError as e:
+            logger.warning(f"Product counter reconciliation failed: {e}")
+
+
+async def get_counter(db: AsyncSession, redis: Redis, field: str):
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.exists(COUNTERS_KEY)
+        pipe.hget(COUNTERS_KEY, field)
+        exists, value = await pipe.execute()
+        if exists:
+            return int(value or 0)
+        return (await reconcile_counters(db, redis)).get(field, 0)
+    except RedisError as e:
+        logger.warning(f"Redis counter read failed, counting in the database: {e}")
+        return (await count_products(db)).get(field, 0)
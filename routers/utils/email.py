@@ -1,10 +1,13 @@
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
-from fastapi_mail.errors import ConnectionErrors
+from fastapi_mail import ConnectionConfig
 
+import aiosmtplib
 from itsdangerous import URLSafeTimedSerializer, BadTimeSignature,SignatureExpired
 
+from email.message import EmailMessage
 from pathlib import Path
 from dotenv import load_dotenv
+import asyncio
+import logging
 import os
 
 from schemas import EmailStr
@@ -12,6 +15,8 @@ from schemas import EmailStr
 
 load_dotenv()
 
+logger = logging.getLogger("uvicorn.error")
+
 token_algo = URLSafeTimedSerializer(os.getenv("SECRET"), salt='Email_Verification_&_Forgot_password')
 
 config = ConnectionConfig(
@@ -28,22 +33,146 @@ config = ConnectionConfig(
     VALIDATE_CERTS = True,
 )
 
-async def send_email_async(subject:str, email_to:EmailStr, body:dict, template:str):
-    
-    message = MessageSchema(
-        subject=subject,
-        recipients= [email_to,],
-        template_body=body,
-        subtype=MessageType.html,
-    )
+templates = config.template_engine()
 
-    fm = FastMail(config)
-    try:
-        await fm.send_message(message, template)
+# Queue
+
+# Messages waiting beyond this are refused, enqueue_email returns False
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", 1000))
+# Messages sent back to back over one connection before checking the queue again
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 20))
+# Delivery attempts per message, waiting 1s, 2s, 4s... between them
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))
+EMAIL_RETRY_DELAY = float(os.getenv("EMAIL_RETRY_DELAY", 1))
+EMAIL_RETRY_MAX_DELAY = float(os.getenv("EMAIL_RETRY_MAX_DELAY", 60))
+# The connection is closed after this long without mail, before the server drops it
+EMAIL_IDLE_SECONDS = float(os.getenv("EMAIL_IDLE_SECONDS", 60))
+# How long shutdown waits for queued mail to go out
+EMAIL_DRAIN_SECONDS = float(os.getenv("EMAIL_DRAIN_SECONDS", 10))
+
+
+class EmailQueue:
+    """Sends mail from a background task over one reused SMTP connection.
+
+    Started and stopped by main.lifespan. Handlers only render the message
+    and put it on the queue, so a request never waits on SMTP.
+    """
+
+    def __init__(self, config: ConnectionConfig):
+        self.config = config
+        self.queue = None
+        self.worker = None
+        self.smtp = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=EMAIL_QUEUE_SIZE)
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        try:
+            await asyncio.wait_for(self.queue.join(), EMAIL_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Email queue stopped with {self.queue.qsize()} messages unsent")
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        await self.disconnect()
+
+    def enqueue(self, message: EmailMessage):
+        if self.queue is None:
+            logger.warning("Email queue is not running, message dropped")
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("Email queue is full, message dropped")
+            return False
         return True
-    except ConnectionErrors as e:
-        return False
-    
+
+    async def run(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), EMAIL_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                await self.disconnect()
+                continue
+
+            batch = [message]
+            while len(batch) < EMAIL_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.send_batch(batch)
+            except Exception as e:
+                logger.exception(f"Email batch failed: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def send_batch(self, batch: list):
+        pending = batch
+        for attempt in range(EMAIL_MAX_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(min(EMAIL_RETRY_DELAY * 2 ** (attempt - 1), EMAIL_RETRY_MAX_DELAY))
+
+            failed = []
+            for message in pending:
+                try:
+                    smtp = await self.connection()
+                    await smtp.send_message(message)
+                except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPSenderRefused) as e:
+                    # Permanent, retrying the same address will not help
+                    logger.warning(f"Email to {message['To']} refused: {e}")
+                except (aiosmtplib.SMTPException, OSError) as e:
+                    logger.warning(f"Email to {message['To']} failed, attempt {attempt + 1}: {e}")
+                    failed.append(message)
+                    # Reconnect for the next message, the connection may be broken
+                    await self.disconnect()
+            if not failed:
+                return
+            pending = failed
+        logger.error(f"Dropped {len(pending)} emails after {EMAIL_MAX_ATTEMPTS} attempts")
+
+    async def connection(self):
+        if self.smtp is not None and self.smtp.is_connected:
+            return self.smtp
+        smtp = aiosmtplib.SMTP(
+            hostname=self.config.MAIL_SERVER,
+            port=self.config.MAIL_PORT,
+            use_tls=self.config.MAIL_SSL_TLS,
+            start_tls=self.config.MAIL_STARTTLS,
+            validate_certs=self.config.VALIDATE_CERTS,
+            timeout=self.config.TIMEOUT,
+        )
+        await smtp.connect()
+        if self.config.USE_CREDENTIALS:
+            await smtp.login(self.config.MAIL_USERNAME, self.config.MAIL_PASSWORD)
+        self.smtp = smtp
+        return smtp
+
+    async def disconnect(self):
+        smtp, self.smtp = self.smtp, None
+        if smtp is None or not smtp.is_connected:
+            return
+        try:
+            await smtp.quit()
+        except aiosmtplib.SMTPException:
+            smtp.close()
+
+
+email_queue = EmailQueue(config)
+
+
+def enqueue_email(subject:str, email_to:EmailStr, body:dict, template:str):
+    # Rendered here, so a template error shows up in the request that caused it
+    message = EmailMessage()
+    message["Subject"] = subject
+    message["From"] = f"{config.MAIL_FROM_NAME} <{config.MAIL_FROM}>"
+    message["To"] = email_to
+    message.set_content(templates.get_template(template).render(**body), subtype="html")
+    return email_queue.enqueue(message)
+
 
 # Token 
 
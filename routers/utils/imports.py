@@ -0,0 +1,81 @@
+import csv
+import io
+import os
+from typing import Optional
+
+import orjson
+from pydantic import ValidationError
+
+from schemas import ProductCreate
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Vars
+
+# Rows inserted per transaction by POST /products/import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 500))
+
+IMPORT_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+# Functions
+
+def import_format(filename: Optional[str]):
+    _, extension = os.path.splitext((filename or "").lower())
+    return IMPORT_FORMATS.get(extension)
+
+
+def iter_import_rows(file, file_format: str):
+    """Yield (row number, record, error) from an uploaded CSV or JSONL file.
+
+    The file is read line by line, never loaded whole. Row numbers are line
+    numbers in the file, so the CSV header is line 1. Exactly one of record
+    and error is None.
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        if file_format == "csv":
+            reader = csv.DictReader(text)
+            for record in reader:
+                # An empty cell means the field's default, not an empty string.
+                # Cells past the header end up under the None key and are dropped.
+                yield reader.line_num, {key: value for key, value in record.items() if key and value not in ("", None)}, None
+        else:
+            for number, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError as e:
+                    yield number, None, f"Invalid JSON: {e}"
+                    continue
+                if not isinstance(record, dict):
+                    yield number, None, "Each line must be a JSON object"
+                    continue
+                yield number, record, None
+    finally:
+        # Leave the upload open, FastAPI closes it after the request
+        text.detach()
+
+
+def validate_import_row(record: dict, category_ids: set, brand_ids: set, user_ids: set):
+    # Returns (values to insert, errors), ids are checked against sets loaded once
+    try:
+        product = ProductCreate.model_validate(record)
+    except ValidationError as e:
+        return None, [f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in e.errors()]
+
+    errors = []
+    if product.category_id not in category_ids:
+        errors.append(f"Category with id {product.category_id} does not exist.")
+    if product.brend_id not in brand_ids:
+        errors.append(f"Brend with id {product.brend_id} does not exist.")
+    if product.author_id not in user_ids:
+        errors.append(f"Author with id {product.author_id} does not exist.")
+    if errors:
+        return None, errors
+    return product.model_dump(), []
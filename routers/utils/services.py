@@ -1,20 +1,34 @@
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
 
-from typing import Optional
+from typing import Optional, List
 
 from fastapi import Query
+from pydantic import TypeAdapter
+from sqlalchemy import select, func, distinct, and_, or_
+from sqlalchemy.dialects.mysql import match
 
 import re
 
 from itsdangerous import URLSafeTimedSerializer
 
-from datetime import datetime, time
+from datetime import datetime, time, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+import base64
+import binascii
+import hashlib
+import orjson
+import pytz
 
 from fastapi import Request
 import os
 
-from models import Product
+from models import Product, ProductSpecification
+from schemas import ProductResponse
+from .cache import CATALOG, PRODUCTS, CATEGORIES, SPECS, category_ns, brand_ns, get_generations, \
+    cache_get_many, cache_set_many, cache_delete, mark_written, replica_fill_blocked, PRODUCT_CACHE_TTL
+from .category_tree import category_ancestors
 
 from dotenv import load_dotenv
 
@@ -39,6 +53,16 @@ serializer = URLSafeTimedSerializer(
     secret_key=os.getenv("SECRET"), salt="email-configuration"
 )
 
+products_adapter = TypeAdapter(List[ProductResponse])
+
+CURSOR_PAGE_SIZE = 20
+
+# Naive timestamps in the database are Baku local time
+TIMEZONE = pytz.timezone("Asia/Baku")
+
+# InnoDB drops shorter words from FULLTEXT indexes (innodb_ft_min_token_size)
+FULLTEXT_MIN_TOKEN_SIZE = int(os.getenv("FULLTEXT_MIN_TOKEN_SIZE", 3))
+
 # Functions
 
 def get_country_from_coordinates(latitude, longitude):
@@ -104,34 +128,99 @@ def get_redis(request: Request):
     return request.app.state.redis
 
 
-def fill_cache_products(products, redis):
-    for product in products:
-        key = f"product:{product.__dict__.get('id')}"
-        redis.hset(
-            key, 
-            mapping={
-                "id": product.__dict__.get("id"),
-                "author_id": product.__dict__.get("author_id"),
-                "category_id": product.__dict__.get("category_id"),
-                "brend_id": product.__dict__.get("brend_id"),
-
-                "name": product.__dict__.get("name"),
-                "model_name":product.__dict__.get("model_name"),
-                "search_string": product.__dict__.get("search_string"),
-
-                "price": product.__dict__.get("price"),
-                "num_product": product.__dict__.get("num_product"),
-                "discount": product.__dict__.get("discount"),
-                
-                "image_link": product.__dict__.get("image_link"),
-
-                "date_created": str(product.date_created),
-                "updated_at": str(product.updated_at),
-
-                "is_super": str(product.__dict__.get("is_super")),
-                "is_new": str(product.__dict__.get("is_new")),
-            }
-        )
+def make_etag(*parts):
+    digest = hashlib.sha1(orjson.dumps(parts, default=str)).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def conditional_headers(etag: str, last_modified: Optional[datetime] = None):
+    # no-cache lets clients keep the body but revalidate it on every use
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        if last_modified.tzinfo is None:
+            last_modified = TIMEZONE.localize(last_modified)
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+async def table_conditional_headers(db, model):
+    # Validators for a whole table from one aggregate row, without loading it
+    last_modified, count, max_id = (await db.execute(select(
+        func.max(model.updated_at), func.count(model.id), func.max(model.id)
+    ))).one()
+    return conditional_headers(make_etag(model.__tablename__, last_modified, count, max_id), last_modified)
+
+
+def is_not_modified(request: Request, headers: dict):
+    # If-None-Match wins over If-Modified-Since, as in RFC 9110
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = headers["ETag"].removeprefix("W/")
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return parsedate_to_datetime(headers["Last-Modified"]) <= since
+    return False
+
+
+async def product_cache_keys(redis, product_ids, prefix: str = "product"):
+    # Per-product entries live under the catalog generation, so a cache
+    # clear drops them too. None when Redis is unavailable.
+    generations = await get_generations(redis, [CATALOG])
+    if not generations:
+        return None
+    return [f"{prefix}:{generations[CATALOG]}:{product_id}" for product_id in product_ids]
+
+
+async def get_cached_products(redis, product_ids, prefix: str = "product"):
+    # Serialized document per id, missing ids are left out
+    keys = await product_cache_keys(redis, product_ids, prefix)
+    if not keys:
+        return {}
+    values = await cache_get_many(redis, keys)
+    return {product_id: value for product_id, value in zip(product_ids, values) if value is not None}
+
+
+async def fill_cache_products(products, redis, db):
+    # Returns the serialized products by id, cached or not. db is the session
+    # they were read with, see cache.replica_fill_blocked.
+    values = {
+        product.id: ProductResponse.model_validate(product).model_dump_json().encode()
+        for product in products
+    }
+    if await replica_fill_blocked(redis, db, *(f"product:{product_id}" for product_id in values)):
+        return values
+    keys = await product_cache_keys(redis, list(values))
+    if keys:
+        await cache_set_many(redis, dict(zip(keys, values.values())), PRODUCT_CACHE_TTL)
+    return values
+
+
+async def evict_cached_products(redis, product_ids):
+    # Drops both the ProductResponse and the full product document
+    product_ids = [product_id for product_id in product_ids if product_id]
+    generations = await get_generations(redis, [CATALOG]) if product_ids else None
+    if generations:
+        await cache_delete(redis, *(
+            f"{prefix}:{generations[CATALOG]}:{product_id}"
+            for prefix in ("product", "product:full") for product_id in product_ids
+        ))
+    await mark_written(redis, *(f"product:{product_id}" for product_id in product_ids))
+
+
+async def product_namespaces(db, redis, product):
+    # A product is listed under its brand, its category and every ancestor of it
+    namespaces = [PRODUCTS, brand_ns(product.brend_id), category_ns(product.category_id)]
+    namespaces += [category_ns(ancestor_id) for ancestor_id in await category_ancestors(db, redis, product.category_id)]
+    return namespaces
 
 
 def check_filters_products(
@@ -153,3 +242,139 @@ def check_filters_products(
         filters.append(Product.price <= max_price)
 
     return filters
+
+
+def normalize_filters_products(
+        category_id: Optional[int] = None,
+        brand_id: Optional[int] = None,
+        available: Optional[bool] = None,
+        discount: Optional[bool] = None,
+        max_price: Optional[float] = None,
+        search_query: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        cursor: Optional[str] = None,
+        specs: Optional[dict] = None,
+    ):
+    # Collapse equivalent filter sets so they share one cache entry
+    search_query = search_query.strip() if search_query else None
+
+    if cursor is not None:
+        # Keyset mode always pages, and never by page number
+        page = None
+        page_size = page_size or CURSOR_PAGE_SIZE
+
+    if search_query:
+        # Search ignores the other filters, see get_all_products
+        category_id = brand_id = available = discount = max_price = specs = None
+
+    return {
+        "category_id": category_id or None,
+        "brand_id": brand_id or None,
+        "available": bool(available),
+        "discount": bool(discount),
+        "max_price": float(max_price) if max_price else None,
+        "search_query": search_query or None,
+        "page": page if (page and page_size) else None,
+        "page_size": page_size or None,
+        "cursor": cursor,
+        # Pairs, not a dict, cache keys are built from JSON with string keys
+        "specs": [[spec_id, values] for spec_id, values in specs.items()] if specs else None,
+    }
+
+
+def namespaces_products(params: dict):
+    # Cache namespaces a listing with these normalized filters depends on
+    namespaces = [CATALOG]
+    if params["category_id"]:
+        # CATEGORIES too, as the descendant set comes from the category tree
+        namespaces += [CATEGORIES, category_ns(params["category_id"])]
+    if params["brand_id"]:
+        namespaces.append(brand_ns(params["brand_id"]))
+    if len(namespaces) == 1:
+        namespaces.append(PRODUCTS)
+    if params.get("specs"):
+        namespaces.append(SPECS)
+    return namespaces
+
+
+def parse_spec_filters(spec: Optional[List[str]]):
+    # spec=12:16GB&spec=12:32GB&spec=7:15.6 -> {7: ["15.6"], 12: ["16GB", "32GB"]}
+    # None if malformed
+    specs = {}
+    for item in spec or []:
+        spec_id, sep, value = item.partition(":")
+        if not sep or not spec_id.strip().isdigit() or not value.strip():
+            return None
+        specs.setdefault(int(spec_id), set()).add(value.strip())
+    return {spec_id: sorted(values) for spec_id, values in sorted(specs.items())}
+
+
+def spec_filter_products(specs: dict):
+    # Values of one specification are alternatives, specifications must all
+    # match. Each (specification, value) lookup is a range of the
+    # ix_product_specifications_spec_value_product index (created by hand,
+    # see models.ProductSpecification), and the GROUP BY intersects the
+    # product id sets.
+    matches = or_(*(
+        and_(ProductSpecification.specification_id == spec_id, ProductSpecification.value.in_(values))
+        for spec_id, values in specs.items()
+    ))
+    product_ids = select(ProductSpecification.product_id)\
+        .where(matches)\
+        .group_by(ProductSpecification.product_id)\
+        .having(func.count(distinct(ProductSpecification.specification_id)) == len(specs))
+    return Product.id.in_(product_ids)
+
+
+def search_products(search_query: str):
+    """Return (filter, relevance) for a search over the ft_products_search index.
+
+    Every word must match as a prefix, so results narrow while the user types.
+    Words too short to be indexed ("15" in "iphone 15") are still required,
+    as substrings of search_string on the rows the index narrowed to.
+    Relevance is None when no word is long enough to be indexed, in which case
+    the filter is the old substring match on search_string.
+    """
+    words = re.findall(r"\w+", search_query.lower())
+    terms = [word for word in words if len(word) >= FULLTEXT_MIN_TOKEN_SIZE]
+    if not terms:
+        return Product.search_string.ilike(f"%{search_query}%"), None
+
+    relevance = match(
+        Product.name, Product.product_model, Product.search_string,
+        against=" ".join(f"+{term}*" for term in terms),
+    ).in_boolean_mode()
+    short_words = [word for word in words if len(word) < FULLTEXT_MIN_TOKEN_SIZE]
+    return and_(relevance, *(Product.search_string.ilike(f"%{word}%") for word in short_words)), relevance
+
+
+def encode_cursor(product):
+    # Opaque to clients, (date_created, id) of the last row of the page
+    raw = orjson.dumps([product.date_created.isoformat(), product.id])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        date_created, product_id = orjson.loads(raw)
+        return datetime.fromisoformat(date_created), int(product_id)
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+        return None
+
+
+def pack_products_page(payload: bytes, next_cursor: Optional[str] = None):
+    # Cached listing value: next cursor on the first line, JSON body after it
+    return (next_cursor or "").encode() + b"\n" + payload
+
+
+def unpack_products_page(value: bytes):
+    next_cursor, _, payload = value.partition(b"\n")
+    return payload, next_cursor.decode() or None
+
+
+def serialize_products(products):
+    return products_adapter.dump_json(
+        products_adapter.validate_python(products, from_attributes=True)
+    )
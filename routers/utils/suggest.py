@@ -0,0 +1,154 @@
+import logging
+import re
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Product, Brand
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+# Vars
+
+# Every completion is a member of one sorted set, all with score 0, so
+# ZRANGEBYLEX gives the members starting with a prefix in O(log N + M).
+# Members look like "<normalized text>\x00<type>\x00<display text>".
+SUGGEST_KEY = "suggest:terms"
+# How many products reference each member, so a member is only removed
+# when the last product using it goes away
+SUGGEST_REFS_KEY = "suggest:refs"
+
+# A completion also matches from inside the text ("pro" -> "iPhone 15 Pro"),
+# up to this many words in
+SUGGEST_MAX_WORDS = 6
+
+
+# Functions
+
+def _words(text: str):
+    return re.findall(r"\w+", text.lower())
+
+
+def suggestion_members(name: str, product_model: str, brand_name: str):
+    members = set()
+    for kind, display in (("name", name), ("model", product_model), ("brand", brand_name)):
+        if not display:
+            continue
+        words = _words(display)
+        for i in range(min(len(words), SUGGEST_MAX_WORDS)):
+            members.add(f"{' '.join(words[i:])}\x00{kind}\x00{display.strip()}")
+    return members
+
+
+async def product_suggestion_members(db: AsyncSession, product):
+    brand_name = await db.scalar(select(Brand.name).where(Brand.id == product.brend_id))
+    return suggestion_members(product.name, product.product_model, brand_name)
+
+
+async def update_suggestions(redis: Redis, added=(), removed=()):
+    # Incremental maintenance on product writes, two round trips at most
+    added, removed = set(added) - set(removed), set(removed) - set(added)
+    if not added and not removed:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for member in added:
+            pipe.hincrby(SUGGEST_REFS_KEY, member, 1)
+        for member in removed:
+            pipe.hincrby(SUGGEST_REFS_KEY, member, -1)
+        counts = await pipe.execute()
+
+        pipe = redis.pipeline(transaction=False)
+        for member, count in zip([*added, *removed], counts):
+            if count > 0:
+                pipe.zadd(SUGGEST_KEY, {member: 0})
+            else:
+                pipe.zrem(SUGGEST_KEY, member)
+                pipe.hdel(SUGGEST_REFS_KEY, member)
+        await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Redis suggestion update failed: {e}")
+
+
+async def rebuild_suggestions(db: AsyncSession, redis: Redis):
+    refs = {}
+    rows = await db.stream(
+        select(Product.name, Product.product_model, Brand.name)
+        .join(Brand, Product.brend_id == Brand.id)
+        .execution_options(yield_per=1000)
+    )
+    async for name, product_model, brand_name in rows:
+        for member in suggestion_members(name, product_model, brand_name):
+            refs[member] = refs.get(member, 0) + 1
+
+    # Build next to the live keys and swap, so lookups never see a half index
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(f"{SUGGEST_KEY}:next", f"{SUGGEST_REFS_KEY}:next")
+    if refs:
+        pipe.zadd(f"{SUGGEST_KEY}:next", {member: 0 for member in refs})
+        pipe.hset(f"{SUGGEST_REFS_KEY}:next", mapping=refs)
+        pipe.rename(f"{SUGGEST_KEY}:next", SUGGEST_KEY)
+        pipe.rename(f"{SUGGEST_REFS_KEY}:next", SUGGEST_REFS_KEY)
+    else:
+        pipe.delete(SUGGEST_KEY, SUGGEST_REFS_KEY)
+    await pipe.execute()
+    logger.info(f"Suggestion index rebuilt with {len(refs)} entries")
+
+
+async def warm_suggestions(redis: Redis, session_factory):
+    # Called at startup, only the first worker to come up pays for the build
+    try:
+        if await redis.exists(SUGGEST_KEY):
+            return
+        async with session_factory() as db:
+            await rebuild_suggestions(db, redis)
+    except RedisError as e:
+        logger.warning(f"Suggestion index warm-up failed: {e}")
+
+
+async def database_suggestions(db: AsyncSession, prefix: str, limit: int):
+    # Fallback while Redis is down: a substring scan, slower and unranked
+    suggestions = []
+    for kind, column, source in (
+        ("name", Product.name, Product),
+        ("model", Product.product_model, Product),
+        ("brand", Brand.name, Brand),
+    ):
+        rows = await db.scalars(
+            select(column).select_from(source).where(column.ilike(f"%{prefix}%")).distinct().limit(limit - len(suggestions))
+        )
+        suggestions.extend({"text": display.strip(), "type": kind} for display in rows)
+        if len(suggestions) >= limit:
+            break
+    return suggestions
+
+
+async def get_suggestions(db: AsyncSession, redis: Redis, q: str, limit: int):
+    prefix = " ".join(_words(q))
+    if not prefix:
+        return []
+
+    # One display text has a member per word, so over-fetch and dedupe
+    try:
+        members = await redis.zrangebylex(
+            SUGGEST_KEY, b"[" + prefix.encode(), b"[" + prefix.encode() + b"\xff",
+            start=0, num=limit * SUGGEST_MAX_WORDS,
+        )
+    except RedisError as e:
+        logger.warning(f"Redis suggestion lookup failed, searching the database: {e}")
+        return await database_suggestions(db, prefix, limit)
+    suggestions = []
+    seen = set()
+    for member in members:
+        _, kind, display = member.decode().split("\x00", 2)
+        if (kind, display) in seen:
+            continue
+        seen.add((kind, display))
+        suggestions.append({"text": display, "type": kind})
+        if len(suggestions) == limit:
+            break
+    return suggestions
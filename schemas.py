@@ -55,6 +55,10 @@ class CategoryResponse(CategoryBase):
     model_config = {"from_attributes": True}
 
 
+class CategoryTreeResponse(CategoryResponse):
+    children: List["CategoryTreeResponse"] = []
+
+
 # Brand Schemas
 class BrandBase(BaseModel):
     name: str
@@ -94,11 +98,22 @@ class ProductCreate(ProductBase):
     pass
 
 
+class ImageVariantResponse(BaseModel):
+    size: str
+    format: str
+    image_link: str
+    width: int
+    height: int
+
+    model_config = {"from_attributes": True}
+
+
 class ProductResponse(ProductBase):
     id: int
     date_created: datetime
     updated_at: datetime
     is_active: Optional[bool] = True
+    image_variants: List[ImageVariantResponse] = []
     model_config = {"from_attributes": True}
 
 
@@ -119,6 +134,58 @@ class ProductUpdate(BaseModel):
     model_config = {"from_attributes": True}
 
 
+class ProductBatchResponse(BaseModel):
+    products: List[ProductResponse]
+    missing: List[int]
+
+
+class FacetCount(BaseModel):
+    id: int
+    count: int
+
+
+class SpecValueCount(BaseModel):
+    value: str
+    count: int
+
+
+class SpecificationFacet(BaseModel):
+    id: int
+    name: str
+    values: List[SpecValueCount]
+
+
+class PriceBucket(BaseModel):
+    min: int
+    max: Optional[int] = None  # None for the last, open-ended bucket
+    count: int
+
+
+class ProductFacetsResponse(BaseModel):
+    total: int
+    in_stock: int
+    discounted: int
+    brands: List[FacetCount]
+    categories: List[FacetCount]
+    price_buckets: List[PriceBucket]
+
+
+class ImportRowError(BaseModel):
+    row: int
+    errors: List[str]
+
+
+class ProductImportResponse(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[ImportRowError]
+
+
+class SuggestionResponse(BaseModel):
+    text: str
+    type: Literal["name", "model", "brand"]
+
+
 # Specification Schemas
 class SpecificationBase(BaseModel):
     name: str
@@ -157,6 +224,11 @@ class ProductSpecificationResponse(ProductSpecificationBase):
     model_config = {"from_attributes": True}
 
 
+class ProductSpecificationBulkResponse(BaseModel):
+    inserted: int
+    updated: int
+
+
 # Image Schemas
 class ImageBase(BaseModel):
     image_link: str
@@ -171,10 +243,43 @@ class ImageResponse(BaseModel):
     id: int
     image_link: str
     product_id: Optional[int] = None
+    variants: List[ImageVariantResponse] = []
 
     model_config = {"from_attributes": True}
 
 
+class ImageUploadRequest(BaseModel):
+    filename: str
+    content_type: str
+
+
+class ImageUploadResponse(BaseModel):
+    url: str
+    fields: dict
+    key: str
+    expires_in: int
+
+
+class ImageUploadConfirm(BaseModel):
+    key: str
+    product_id: Optional[int] = None
+
+
+# Product Detail Schemas
+class ProductSpecificationDetail(BaseModel):
+    id: int
+    specification_id: int
+    name: str
+    value: str
+
+
+class ProductDetailResponse(ProductResponse):
+    brend: Optional[BrandResponse] = None
+    category: Optional[CategoryResponse] = None
+    images: List[ImageResponse] = []
+    specifications: List[ProductSpecificationDetail] = []
+
+
 # JWT Token Schemas
 class Token(BaseModel):
     access_token: str